@@ -0,0 +1,527 @@
+"""
+Benchmarks for the segmentation pipeline. They run on synthetic data, need neither the KITTI dataset nor the
+pretrained VGG model, and write their results as JSON so they can be compared across commits.
+
+    python benchmark.py startup --budget 10
+    python benchmark.py --output results.json throughput --batch-sizes 1 4 8 --image-shapes 160x576 320x1152
+    python benchmark.py augment
+    python benchmark.py scaling --replicas 1 2 4
+    python benchmark.py labels --light
+    python benchmark.py masks --run runs/1500000000.0
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import glob
+import shutil
+import subprocess
+
+import numpy as np
+import tensorflow as tf
+
+REPO_PATH = os.path.dirname(os.path.abspath(__file__))
+IMAGE_SHAPE = (160, 576)
+VGG_CHANNELS = (256, 512, 4096)                 # Channels of the VGG layer 3, 4 and 7 outputs
+LIGHT_CHANNELS = (32, 64, 128)                  # Scaled down channels for quick runs
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=REPO_PATH,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def write_results(name, results, output):
+    """
+    Write benchmark results as JSON together with the commit they were measured on
+    :param name: Name of the benchmark
+    :param results: JSON serializable results
+    :param output: Path of the JSON file, None prints the results
+    """
+    report = {'benchmark': name, 'commit': git_commit(), 'time': time.time(), 'results': results}
+    text = json.dumps(report, indent=2, sort_keys=True)
+    if output:
+        with open(output, 'w') as f:
+            f.write(text)
+    print(text)
+
+
+def synthetic_encoder(image_input, channels=VGG_CHANNELS):
+    """
+    Stand-in for the VGG encoder with the same output strides (8, 16 and 32) and channel counts
+    :param image_input: TF Tensor of shape (N, H, W, 3)
+    :param channels: Tuple with the channels of the layer 3, 4 and 7 outputs
+    :return: Tuple of Tensors (layer3_out, layer4_out, layer7_out)
+    """
+    x = tf.layers.average_pooling2d(tf.cast(image_input, tf.float32), 8, 8)
+    layer3_out = tf.layers.conv2d(x, channels[0], 3, padding='same', activation=tf.nn.relu, name='layer3')
+    x = tf.layers.max_pooling2d(layer3_out, 2, 2)
+    layer4_out = tf.layers.conv2d(x, channels[1], 3, padding='same', activation=tf.nn.relu, name='layer4')
+    x = tf.layers.max_pooling2d(layer4_out, 2, 2)
+    layer7_out = tf.layers.conv2d(x, channels[2], 1, activation=tf.nn.relu, name='layer7')
+    return layer3_out, layer4_out, layer7_out
+
+
+def synthetic_graph_def(channels=VGG_CHANNELS):
+    """
+    Frozen graph of the FCN decoder on top of the synthetic encoder, with the same inputs and outputs as a model
+    exported with "python main.py export"
+    :param channels: Tuple with the channels of the encoder outputs
+    :return: GraphDef
+    """
+    import main
+    import inference
+
+    with tf.Graph().as_default(), tf.Session() as sess:
+        image_input = tf.placeholder(tf.float32, (None, None, None, 3), name='image_input')
+        last_layer = main.layers(*synthetic_encoder(image_input, channels), main.NUM_CLASSES)
+        inference.add_output_ops(last_layer)
+        sess.run(tf.global_variables_initializer())
+        return inference.freeze_graph(sess)
+
+
+_STARTUP_SCRIPT = '''
+import sys, json, time
+start = time.time()
+import main
+import_main = time.time() - start
+import numpy as np
+import inference
+image_shape = (int(sys.argv[2]), int(sys.argv[3]))
+engine = inference.load_frozen_model(sys.argv[1], image_shape, batch_size=1)
+model_loaded = time.time() - start
+engine.predict(np.zeros((1,) + image_shape + (3,), np.uint8))
+first_prediction = time.time() - start
+print(json.dumps({'import_main': import_main, 'model_loaded': model_loaded, 'first_prediction': first_prediction}))
+'''
+
+
+def bench_startup(args):
+    """Measure the latency from a cold interpreter to the first prediction in a fresh process"""
+    model_path = args.model
+    work_dir = None
+    if not model_path:
+        work_dir = tempfile.mkdtemp()
+        model_path = os.path.join(work_dir, 'synthetic-frozen.pb')
+        with open(model_path, 'wb') as f:
+            f.write(synthetic_graph_def(LIGHT_CHANNELS).SerializeToString())
+
+    runs = []
+    try:
+        for _ in range(args.repeat):
+            output = subprocess.check_output([sys.executable, '-c', _STARTUP_SCRIPT, model_path,
+                                              str(IMAGE_SHAPE[0]), str(IMAGE_SHAPE[1])], cwd=REPO_PATH)
+            runs.append(json.loads(output.decode().strip().splitlines()[-1]))
+    finally:
+        if work_dir:
+            shutil.rmtree(work_dir)
+
+    results = {key: float(np.median([run[key] for run in runs])) for key in runs[0]}
+    results['model'] = args.model or 'synthetic'
+    results['repeat'] = args.repeat
+    write_results('startup', results, args.output)
+
+    if args.budget and results['first_prediction'] > args.budget:
+        sys.exit('Import to first prediction took {:.2f}s, budget is {:.2f}s'.format(
+            results['first_prediction'], args.budget))
+
+
+def write_synthetic_kitti(data_folder, count, frame_shape=(375, 1242), seed=0):
+    """
+    Write a synthetic dataset with the KITTI road layout: RGB images in image_2 and road ground truth in gt_image_2,
+    where the background is red and the road is magenta
+    :param data_folder: Folder to write "image_2" and "gt_image_2" to
+    :param count: Number of image pairs
+    :param frame_shape: Tuple - Shape of the images
+    :param seed: Random seed
+    """
+    import scipy.misc
+
+    rng = np.random.RandomState(seed)
+    os.makedirs(os.path.join(data_folder, 'image_2'), exist_ok=True)
+    os.makedirs(os.path.join(data_folder, 'gt_image_2'), exist_ok=True)
+    rows = np.arange(frame_shape[0])[:, np.newaxis]
+    for i in range(count):
+        image = rng.randint(0, 256, size=frame_shape + (3,), dtype=np.uint8)
+        gt_image = np.zeros(frame_shape + (3,), np.uint8)
+        gt_image[..., 0] = 255
+        # Road in the lower part of the image, with a random horizon
+        gt_image[..., 2] = np.where(rows > rng.randint(frame_shape[0] // 3, frame_shape[0]), 255, 0)
+        scipy.misc.imsave(os.path.join(data_folder, 'image_2', 'um_%06d.png' % i), image)
+        scipy.misc.imsave(os.path.join(data_folder, 'gt_image_2', 'um_road_%06d.png' % i), gt_image)
+
+
+def _images_per_second(fn, batch_size, steps):
+    fn()
+    start = time.time()
+    for _ in range(steps):
+        fn()
+    return batch_size * steps / (time.time() - start)
+
+
+def bench_loading(data_folder, image_shape, batch_size, cache_dir):
+    """Images per second for one epoch of gen_batch_function, uncached and from the memmap cache"""
+    import helper
+
+    results = {}
+    for name, cache in (('load_png', None), ('load_cached', cache_dir)):
+        get_batches_fn = helper.gen_batch_function(data_folder, image_shape, cache_dir=cache)
+        # The first epoch builds the cache
+        count = sum(len(images) for images, _ in get_batches_fn(batch_size))
+        start = time.time()
+        count = sum(len(images) for images, _ in get_batches_fn(batch_size))
+        results[name] = count / (time.time() - start)
+    return results
+
+
+def bench_model(image_shape, batch_size, channels, steps, checkpoint_dir):
+    """Images per second for the forward pass, the training step, checkpointing and inference"""
+    import main
+    from inference import InferenceEngine
+
+    rng = np.random.RandomState(0)
+    images = rng.randint(0, 256, size=(batch_size,) + image_shape + (3,)).astype(np.uint8)
+    labels = np.zeros((batch_size,) + image_shape + (main.NUM_CLASSES,), np.bool_)
+    labels[..., 1] = rng.rand(batch_size, *image_shape) > 0.5
+    labels[..., 0] = ~labels[..., 1]
+
+    with tf.Graph().as_default(), tf.Session() as sess:
+        image_input = tf.placeholder(tf.float32, (None, None, None, 3), name='image_input')
+        last_layer = main.layers(*synthetic_encoder(image_input, channels), main.NUM_CLASSES)
+        correct_label = tf.placeholder(tf.float32, (None,) + image_shape + (main.NUM_CLASSES,))
+        learning_rate = tf.placeholder(tf.float32)
+        logits, train_op, cross_entropy_loss = main.optimize(last_layer, correct_label, learning_rate,
+                                                             main.NUM_CLASSES)
+        engine = InferenceEngine(sess, image_input, image_shape, logits=last_layer, batch_size=batch_size)
+        saver = tf.train.Saver()
+        sess.run(tf.global_variables_initializer())
+
+        feed_dict = {image_input: images, correct_label: labels, learning_rate: main.LEARNING_RATE}
+        results = {
+            'forward': _images_per_second(lambda: sess.run(last_layer, feed_dict), batch_size, steps),
+            'train_step': _images_per_second(lambda: sess.run(train_op, feed_dict), batch_size, steps),
+            'inference': _images_per_second(lambda: engine.predict(images), batch_size, steps)}
+        # Backward pass and weight update alone, derived from the time per image of both passes
+        results['backward'] = 1. / max(1. / results['train_step'] - 1. / results['forward'], 1e-9)
+
+        checkpoint_path = os.path.join(checkpoint_dir, 'benchmark.ckpt')
+        start = time.time()
+        saver.save(sess, checkpoint_path)
+        results['checkpoint_seconds'] = time.time() - start
+    return results
+
+
+def bench_throughput(args):
+    """Images per second of every training and inference stage across batch sizes and image shapes"""
+    channels = LIGHT_CHANNELS if args.light else VGG_CHANNELS
+    work_dir = tempfile.mkdtemp()
+    try:
+        data_folder = os.path.join(work_dir, 'training')
+        write_synthetic_kitti(data_folder, args.images)
+
+        results = []
+        for image_shape in args.image_shapes:
+            for batch_size in args.batch_sizes:
+                result = {'image_shape': list(image_shape), 'batch_size': batch_size}
+                result.update(bench_loading(data_folder, image_shape, batch_size, os.path.join(work_dir, 'cache')))
+                result.update(bench_model(image_shape, batch_size, channels, args.steps, work_dir))
+                print(result)
+                results.append(result)
+    finally:
+        shutil.rmtree(work_dir)
+
+    write_results('throughput', {'channels': list(channels), 'images': args.images, 'runs': results},
+                  args.output)
+
+
+def bench_augment(args):
+    """Cost per batch of BatchAugmenter, gathering from a memmap like the cached batch function does"""
+    import helper
+
+    augmenter = helper.BatchAugmenter()
+    work_dir = tempfile.mkdtemp()
+    try:
+        results = []
+        for image_shape in args.image_shapes:
+            images = np.lib.format.open_memmap(os.path.join(work_dir, 'images.npy'), mode='w+', dtype=np.uint8,
+                                               shape=(args.images,) + image_shape + (3,))
+            # Class index labels as stored by helper.preprocess_dataset
+            labels = np.lib.format.open_memmap(os.path.join(work_dir, 'labels.npy'), mode='w+', dtype=np.uint8,
+                                               shape=(args.images,) + image_shape)
+            images[:] = np.random.RandomState(0).randint(0, 256, size=images.shape)
+            for batch_size in args.batch_sizes:
+                rng = np.random.RandomState(0)
+                timings = []
+                for _ in range(args.steps):
+                    indices = np.sort(rng.choice(args.images, batch_size, replace=False))
+                    start = time.time()
+                    augmenter(images, labels, rng, indices)
+                    timings.append(time.time() - start)
+                # Same gather without augmentation, the cost of serving the batch at all
+                start = time.time()
+                for _ in range(args.steps):
+                    indices = np.sort(rng.choice(args.images, batch_size, replace=False))
+                    images[indices], labels[indices]
+                gather_ms = 1000. * (time.time() - start) / args.steps
+                result = {'image_shape': list(image_shape), 'batch_size': batch_size,
+                          'augment_ms_per_batch': 1000. * float(np.median(timings)),
+                          'gather_ms_per_batch': gather_ms}
+                print(result)
+                results.append(result)
+            del images, labels
+    finally:
+        shutil.rmtree(work_dir)
+
+    write_results('augment', results, args.output)
+
+
+def bench_scaling(args):
+    """Training images per second and scaling efficiency of data-parallel training from 1 to N replicas"""
+    import main
+    import parallel
+
+    channels = LIGHT_CHANNELS if args.light else VGG_CHANNELS
+    rng = np.random.RandomState(0)
+    images = rng.randint(0, 256, size=(args.batch_size,) + IMAGE_SHAPE + (3,)).astype(np.uint8)
+    labels = np.zeros((args.batch_size,) + IMAGE_SHAPE + (main.NUM_CLASSES,), np.bool_)
+    labels[..., 1] = rng.rand(args.batch_size, *IMAGE_SHAPE) > 0.5
+    labels[..., 0] = ~labels[..., 1]
+
+    def encoder(replica):
+        image_input = tf.placeholder(tf.float32, (None, None, None, 3), name='image_input_%d' % replica)
+        return (image_input, keep_prob) + synthetic_encoder(image_input, channels)
+
+    results = []
+    for num_replicas in args.replicas:
+        cluster = parallel.LocalCluster(num_replicas, args.threads_per_replica)
+        with tf.Graph().as_default(), cluster.session() as sess:
+            keep_prob = tf.placeholder(tf.float32, name='keep_prob')
+            learning_rate = tf.placeholder(tf.float32)
+            replicas = parallel.build_replicas(encoder, main.layers, main.cross_entropy, cluster.devices,
+                                               IMAGE_SHAPE, main.NUM_CLASSES, learning_rate)
+            sess.run(tf.global_variables_initializer())
+
+            feed_dict = {learning_rate: main.LEARNING_RATE, keep_prob: 1.}
+            feed_dict.update(main.shard_feed(replicas.input_images, images))
+            feed_dict.update(main.shard_feed(replicas.correct_labels, labels))
+            result = {'replicas': num_replicas,
+                      'images_per_second': _images_per_second(lambda: sess.run(replicas.train_op, feed_dict),
+                                                              args.batch_size, args.steps)}
+        result['efficiency'] = result['images_per_second'] / (num_replicas * results[0]['images_per_second']
+                                                              / results[0]['replicas']) if results else 1.
+        print(result)
+        results.append(result)
+
+    write_results('scaling', {'batch_size': args.batch_size, 'channels': list(channels), 'runs': results},
+                  args.output)
+
+
+def bench_labels(args):
+    """Bytes fed per training step and training images per second with dense one-hot and sparse class index labels"""
+    import main
+    import helper
+
+    channels = LIGHT_CHANNELS if args.light else VGG_CHANNELS
+    work_dir = tempfile.mkdtemp()
+    try:
+        data_folder = os.path.join(work_dir, 'training')
+        write_synthetic_kitti(data_folder, args.batch_size)
+
+        results = {}
+        cache_dir = os.path.join(work_dir, 'cache')
+        for label_format in helper.LABEL_FORMATS:
+            get_batches_fn = helper.gen_batch_function(data_folder, IMAGE_SHAPE, cache_dir=cache_dir, shuffle=False,
+                                                       label_format=label_format)
+            images, labels = next(get_batches_fn(args.batch_size))
+
+            with tf.Graph().as_default(), tf.Session() as sess:
+                image_input = tf.placeholder(tf.float32, (None, None, None, 3), name='image_input')
+                last_layer = main.layers(*synthetic_encoder(image_input, channels), main.NUM_CLASSES)
+                correct_label = main.label_placeholder(IMAGE_SHAPE, main.NUM_CLASSES, label_format)
+                learning_rate = tf.placeholder(tf.float32)
+                _, train_op, _ = main.optimize(last_layer, correct_label, learning_rate, main.NUM_CLASSES)
+                sess.run(tf.global_variables_initializer())
+
+                # Feeding converts the labels to the dtype of the placeholder, which is what gets copied per step
+                label_bytes = np.asarray(labels, correct_label.dtype.as_numpy_dtype).nbytes
+                feed_dict = {image_input: images, correct_label: labels, learning_rate: main.LEARNING_RATE}
+                results[label_format] = {
+                    'label_bytes_per_step': label_bytes,
+                    'image_bytes_per_step': np.asarray(images, np.float32).nbytes,
+                    'loaded_label_bytes': labels.nbytes,
+                    'train_images_per_second': _images_per_second(lambda: sess.run(train_op, feed_dict),
+                                                                  args.batch_size, args.steps)}
+            print(label_format, results[label_format])
+    finally:
+        shutil.rmtree(work_dir)
+
+    results['label_bytes_ratio'] = (results['dense']['label_bytes_per_step'] /
+                                    results['sparse']['label_bytes_per_step'])
+    write_results('labels', {'batch_size': args.batch_size, 'channels': list(channels), 'runs': results},
+                  args.output)
+
+
+def synthetic_predictions(count, image_shape, seed=0):
+    """
+    Images with road predictions shaped like real ones: a smooth road probability below a wavy horizon and
+    smooth, lightly noisy images, so PNG compresses them about as well as camera images
+    :param count: Number of predictions
+    :param image_shape: Tuple - Shape of the images
+    :param seed: Random seed
+    :return: Generator of (name, image, road probability, road mask)
+    """
+    rng = np.random.RandomState(seed)
+    rows, cols = np.mgrid[:image_shape[0], :image_shape[1]].astype(np.float32)
+    for i in range(count):
+        horizon = image_shape[0] * (0.5 + 0.1 * np.sin(cols / image_shape[1] * rng.uniform(2., 8.)))
+        probability = 1. / (1. + np.exp(-(rows - horizon) / 3.))
+        image = (rows / image_shape[0] * 160. + cols / image_shape[1] * 60.)[..., np.newaxis] + [20., 40., 60.]
+        image = (image + rng.randint(0, 12, size=image.shape)).astype(np.uint8)
+        yield 'um_%06d.png' % i, image, probability, probability > 0.5
+
+
+def _directory_bytes(paths):
+    return sum(os.path.getsize(path) for path in paths)
+
+
+def bench_masks(args):
+    """Bytes per image and write/read speed of the mask container against PNG overlays and .npy masks"""
+    import helper
+    import mask_io
+    from PIL import Image
+    from inference import overlay
+
+    predictions = list(synthetic_predictions(args.images, args.image_shape))
+    names = [name for name, _, _, _ in predictions]
+    work_dir = tempfile.mkdtemp()
+    results = {}
+    try:
+        def timed(name, write, read, paths):
+            """Time writing all predictions, then reading them back by name in random order"""
+            start = time.time()
+            write()
+            write_seconds = time.time() - start
+            order = np.random.RandomState(0).permutation(names)
+            start = time.time()
+            for image_name in order:
+                read(image_name)
+            results[name] = {'bytes_per_image': _directory_bytes(paths) / float(len(names)),
+                             'write_images_per_second': len(names) / write_seconds,
+                             'random_read_ms': 1000. * (time.time() - start) / len(names)}
+            print(name, results[name])
+
+        png_dir = os.path.join(work_dir, 'png')
+        os.makedirs(png_dir)
+
+        def write_png():
+            for name, image, _, mask in predictions:
+                Image.fromarray(overlay(image[np.newaxis], mask[np.newaxis])[0]).save(os.path.join(png_dir, name))
+        timed('png_overlay', write_png, lambda name: np.array(Image.open(os.path.join(png_dir, name))),
+              [os.path.join(png_dir, name) for name in names])
+
+        npy_dir = os.path.join(work_dir, 'npy')
+        os.makedirs(npy_dir)
+
+        def write_npy():
+            for name, _, _, mask in predictions:
+                np.save(os.path.join(npy_dir, name[:-4] + '.npy'), mask)
+        timed('npy_mask', write_npy, lambda name: np.load(os.path.join(npy_dir, name[:-4] + '.npy')),
+              [os.path.join(npy_dir, name[:-4] + '.npy') for name in names])
+
+        for encoding in mask_io.MASK_ENCODINGS:
+            for save_probabilities in (False, True):
+                path = os.path.join(work_dir, '{}_{}.bin'.format(encoding, save_probabilities))
+                readers = []
+
+                def write_masks():
+                    helper._save_mask_container(
+                        path, ((name, probability, mask) for name, _, probability, mask in predictions),
+                        encoding, save_probabilities)
+                    readers.append(mask_io.MaskReader(path))
+
+                def read_masks(name):
+                    return readers[0].mask(name), readers[0].probability(name)
+                timed('masks_{}{}'.format(encoding, '_probabilities' if save_probabilities else ''),
+                      write_masks, read_masks, [path])
+                readers[0].close()
+    finally:
+        shutil.rmtree(work_dir)
+
+    if args.run:
+        # Reference sizes of a real run in runs/
+        pngs = glob.glob(os.path.join(args.run, '*.png'))
+        if pngs:
+            results['run_png_overlay_bytes_per_image'] = _directory_bytes(pngs) / float(len(pngs))
+        container = os.path.join(args.run, helper.MASK_CONTAINER)
+        if os.path.exists(container):
+            with mask_io.MaskReader(container) as reader:
+                results['run_masks_bytes_per_image'] = os.path.getsize(container) / float(max(len(reader), 1))
+
+    results['png_overlay_vs_masks_rle_size'] = (results['png_overlay']['bytes_per_image'] /
+                                                results['masks_rle']['bytes_per_image'])
+    write_results('masks', {'images': args.images, 'image_shape': list(args.image_shape), 'runs': results},
+                  args.output)
+
+
+def image_shape_arg(text):
+    height, width = text.lower().split('x')
+    return int(height), int(width)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmarks for the segmentation pipeline')
+    parser.add_argument('--output', help='Write the JSON results to this file')
+    subparsers = parser.add_subparsers(dest='benchmark')
+    subparsers.required = True
+
+    startup_parser = subparsers.add_parser('startup', help='Import to first prediction latency')
+    startup_parser.add_argument('--model', help='Frozen model, a synthetic model is used by default')
+    startup_parser.add_argument('--repeat', type=int, default=3, help='Number of fresh processes to measure')
+    startup_parser.add_argument('--budget', type=float, help='Fail if the first prediction takes longer (seconds)')
+    startup_parser.set_defaults(func=bench_startup)
+
+    throughput_parser = subparsers.add_parser('throughput', help='Images/sec of each training and inference stage')
+    throughput_parser.add_argument('--batch-sizes', type=int, nargs='+', default=[1, 4, 10], help='Batch sizes')
+    throughput_parser.add_argument('--image-shapes', type=image_shape_arg, nargs='+', default=[IMAGE_SHAPE],
+                                   help='Image shapes as HEIGHTxWIDTH')
+    throughput_parser.add_argument('--images', type=int, default=40, help='Number of synthetic training images')
+    throughput_parser.add_argument('--steps', type=int, default=5, help='Timed steps per measurement')
+    throughput_parser.add_argument('--light', action='store_true', help='Use a scaled down synthetic encoder')
+    throughput_parser.set_defaults(func=bench_throughput)
+
+    augment_parser = subparsers.add_parser('augment', help='Cost per batch of the data augmentation')
+    augment_parser.add_argument('--batch-sizes', type=int, nargs='+', default=[1, 4, 10], help='Batch sizes')
+    augment_parser.add_argument('--image-shapes', type=image_shape_arg, nargs='+', default=[IMAGE_SHAPE],
+                                help='Image shapes as HEIGHTxWIDTH')
+    augment_parser.add_argument('--images', type=int, default=64, help='Number of images to sample batches from')
+    augment_parser.add_argument('--steps', type=int, default=20, help='Timed batches per measurement')
+    augment_parser.set_defaults(func=bench_augment)
+
+    scaling_parser = subparsers.add_parser('scaling', help='Data-parallel training scaling efficiency')
+    scaling_parser.add_argument('--replicas', type=int, nargs='+', default=[1, 2, 4], help='Replica counts')
+    scaling_parser.add_argument('--threads-per-replica', type=int, help='Intra-op threads per replica')
+    scaling_parser.add_argument('--batch-size', type=int, default=8, help='Global batch size')
+    scaling_parser.add_argument('--steps', type=int, default=5, help='Timed steps per measurement')
+    scaling_parser.add_argument('--light', action='store_true', help='Use a scaled down synthetic encoder')
+    scaling_parser.set_defaults(func=bench_scaling)
+
+    labels_parser = subparsers.add_parser('labels', help='Bytes fed per step with dense and sparse labels')
+    labels_parser.add_argument('--batch-size', type=int, default=10, help='Batch size')
+    labels_parser.add_argument('--steps', type=int, default=5, help='Timed steps per measurement')
+    labels_parser.add_argument('--light', action='store_true', help='Use a scaled down synthetic encoder')
+    labels_parser.set_defaults(func=bench_labels)
+
+    masks_parser = subparsers.add_parser('masks', help='Size and speed of the mask container against PNG overlays')
+    masks_parser.add_argument('--images', type=int, default=100, help='Number of synthetic predictions')
+    masks_parser.add_argument('--image-shape', type=image_shape_arg, default=IMAGE_SHAPE,
+                              help='Image shape as HEIGHTxWIDTH')
+    masks_parser.add_argument('--run', help='Directory in runs/ to report the sizes of as a reference')
+    masks_parser.set_defaults(func=bench_masks)
+
+    args = parser.parse_args()
+    args.func(args)
@@ -0,0 +1,144 @@
+import os
+import json
+import time
+from glob import glob
+from concurrent.futures import ThreadPoolExecutor
+
+import tensorflow as tf
+from tensorflow.python.ops import io_ops
+
+
+class CheckpointManager(object):
+    """
+    Save checkpoints without blocking training. The variables are copied out of the session, which is the only
+    time training stalls, and written by a background thread from that snapshot. One save op is built up front
+    and reused, and only the last keep_last checkpoints plus the keep_best best ones by metric are kept on disk.
+    """
+    INDEX_FILE = 'checkpoints.json'
+
+    def __init__(self, checkpoint_dir, var_list=None, prefix='P2-epoch', keep_last=3, keep_best=1, mode='min',
+                 resume=False):
+        """
+        :param checkpoint_dir: Directory to write the checkpoints to
+        :param var_list: Variables to save, all global variables by default
+        :param prefix: File name prefix, the epoch and '.ckpt' are appended
+        :param keep_last: Number of most recent checkpoints to keep
+        :param keep_best: Number of checkpoints with the best metric to keep
+        :param mode: 'min' if a lower metric is better, 'max' if a higher metric is better
+        :param resume: Continue the index of checkpoint_dir. Otherwise a new index is started, so the checkpoints
+                       of an earlier run are neither restored nor counted by the retention of this one.
+        """
+        assert mode in ('min', 'max'), 'Unknown mode {}'.format(mode)
+        self.checkpoint_dir = checkpoint_dir
+        self.var_list = var_list if var_list is not None else tf.global_variables()
+        self.prefix = prefix
+        self.keep_last = keep_last
+        self.keep_best = keep_best
+        self.mode = mode
+        self.saver = tf.train.Saver(self.var_list, max_to_keep=None)
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.pending = None
+        self.stall_times = []
+        self.write_times = []
+
+        # Separate graph that writes a snapshot fed through placeholders, in the same format as self.saver
+        self.writer_graph = tf.Graph()
+        with self.writer_graph.as_default():
+            self.path_pl = tf.placeholder(tf.string)
+            self.value_pls = [tf.placeholder(var.dtype.base_dtype, var.get_shape()) for var in self.var_list]
+            names = [var.op.name for var in self.var_list]
+            self.save_op = io_ops.save_v2(self.path_pl, names, [''] * len(names), self.value_pls)
+        self.writer_sess = tf.Session(graph=self.writer_graph)
+
+        os.makedirs(checkpoint_dir, exist_ok=True)
+        self.index = []
+        index_path = os.path.join(checkpoint_dir, self.INDEX_FILE)
+        if resume and os.path.exists(index_path):
+            with open(index_path) as f:
+                self.index = json.load(f)
+
+    def checkpoint_path(self, epoch):
+        return os.path.join(self.checkpoint_dir, '{}{}.ckpt'.format(self.prefix, epoch))
+
+    def save(self, sess, epoch, metric=None):
+        """
+        Snapshot the variables and write them in the background
+        :param sess: TF Session
+        :param epoch: Epoch the checkpoint belongs to
+        :param metric: Validation metric used to decide which checkpoints to keep
+        :return: Seconds training was stalled
+        """
+        start = time.time()
+        # Only one write in flight, so snapshots never pile up in memory
+        self.wait()
+        values = sess.run(self.var_list)
+        stall = time.time() - start
+        self.stall_times.append(stall)
+
+        self.pending = self.executor.submit(self._write, epoch, metric, values)
+        return stall
+
+    def _write(self, epoch, metric, values):
+        start = time.time()
+        path = self.checkpoint_path(epoch)
+        feed_dict = dict(zip(self.value_pls, values))
+        feed_dict[self.path_pl] = path
+        self.writer_sess.run(self.save_op, feed_dict)
+
+        self.index = [entry for entry in self.index if entry['epoch'] != epoch]
+        self.index.append({'epoch': epoch, 'path': path, 'metric': metric})
+        self._apply_retention()
+        tf.train.update_checkpoint_state(self.checkpoint_dir, path,
+                                         [entry['path'] for entry in self.index])
+        self.write_times.append(time.time() - start)
+
+    def _apply_retention(self):
+        by_epoch = sorted(self.index, key=lambda entry: entry['epoch'])
+        keep = set(entry['epoch'] for entry in by_epoch[-self.keep_last:]) if self.keep_last else set()
+        scored = [entry for entry in self.index if entry['metric'] is not None]
+        scored.sort(key=lambda entry: entry['metric'], reverse=self.mode == 'max')
+        keep.update(entry['epoch'] for entry in scored[:self.keep_best])
+
+        for entry in self.index:
+            if entry['epoch'] not in keep:
+                for checkpoint_file in glob(entry['path'] + '.*'):
+                    os.remove(checkpoint_file)
+        self.index = [entry for entry in by_epoch if entry['epoch'] in keep]
+
+        index_path = os.path.join(self.checkpoint_dir, self.INDEX_FILE)
+        with open(index_path + '.tmp', 'w') as f:
+            json.dump(self.index, f, indent=2)
+        os.replace(index_path + '.tmp', index_path)
+
+    def wait(self):
+        """Wait for the checkpoint being written, if any"""
+        if self.pending is not None:
+            pending, self.pending = self.pending, None
+            pending.result()
+
+    def best(self):
+        """
+        :return: Index entry of the checkpoint with the best metric, None if there is none
+        """
+        scored = [entry for entry in self.index if entry['metric'] is not None]
+        if not scored:
+            return None
+        return (max if self.mode == 'max' else min)(scored, key=lambda entry: entry['metric'])
+
+    def restore_latest(self, sess):
+        """
+        Restore the most recent checkpoint, if any
+        :param sess: TF Session
+        :return: Epoch to continue training from, 0 when there is no checkpoint
+        """
+        if not self.index:
+            return 0
+        latest = max(self.index, key=lambda entry: entry['epoch'])
+        self.saver.restore(sess, latest['path'])
+        print('Resuming from checkpoint: %s' % latest['path'])
+        return latest['epoch'] + 1
+
+    def close(self):
+        self.wait()
+        self.executor.shutdown(wait=True)
+        self.writer_sess.close()
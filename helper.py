@@ -1,15 +1,29 @@
 import re
+import json
 import random
+import hashlib
 import numpy as np
 import os.path
 import scipy.misc
 import shutil
 import zipfile
+import sys
 import time
-import tensorflow as tf
+import queue
+import threading
 from glob import glob
-from urllib.request import urlretrieve
+from itertools import count
+from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from contextlib import contextmanager
+from urllib.error import HTTPError
+from urllib.parse import urlparse
+from urllib.request import Request, url2pathname, urlopen
+from PIL import Image
 from tqdm import tqdm
+from inference import InferenceEngine, TiledInference, overlay
+from mask_io import MaskWriter
 
 
 class DLProgress(tqdm):
@@ -21,84 +35,661 @@ class DLProgress(tqdm):
         self.last_block = block_num
 
 
-def maybe_download_pretrained_vgg(data_dir):
+def peak_rss_mb():
     """
-    Download and extract pretrained vgg model if it doesn't exist
-    :param data_dir: Directory to download the model to
+    :return: Peak resident set size of this process in MB, None where the resource module is not available
     """
-    vgg_filename = 'vgg.zip'
+    try:
+        # Unix only
+        import resource
+    except ImportError:
+        return None
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes everywhere else
+    return peak_rss / 2**20 if sys.platform == 'darwin' else peak_rss / 2**10
+
+
+def current_rss_mb():
+    """
+    :return: Current resident set size of this process in MB, None where /proc is not available
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2**20
+    except (IOError, OSError):
+        return None
+
+
+VGG_FILENAME = 'vgg.zip'
+VGG_URL = 'https://s3-us-west-1.amazonaws.com/udacity-selfdrivingcar/' + VGG_FILENAME
+VGG_FILES = ['variables/variables.data-00000-of-00001', 'variables/variables.index', 'saved_model.pb']
+
+
+def _sha256(path, chunk_size=2**20):
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+@contextmanager
+def file_lock(path):
+    """
+    Exclusive lock held across processes for the duration of the with block
+    :param path: Path of the lock file, created if it does not exist
+    """
+    # Only available on Unix, so only needed when a model is provisioned
+    import fcntl
+
+    with open(path, 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def download_resumable(url, path, chunk_size=2**20):
+    """
+    Download a file, continuing a previous partial download kept in path + '.part'. HTTP servers are asked for
+    the missing byte range only, file:// URLs are read from the offset directly.
+    :param url: http(s):// or file:// URL
+    :param path: Path to move the completed download to
+    :param chunk_size: Bytes per read
+    """
+    part_path = path + '.part'
+    offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+
+    if url.startswith('file://'):
+        source = open(url2pathname(urlparse(url).path), 'rb')
+        total = os.fstat(source.fileno()).st_size
+        offset = min(offset, total)
+        source.seek(offset)
+    else:
+        try:
+            source = urlopen(Request(url, headers={'Range': 'bytes=%d-' % offset} if offset else {}))
+        except HTTPError as e:
+            if e.code != 416:
+                raise
+            # Range not satisfiable, the partial download is already complete
+            os.replace(part_path, path)
+            return
+        if offset and source.status != 206:
+            # The server ignored the range, start over
+            offset = 0
+        length = source.headers.get('Content-Length')
+        total = offset + int(length) if length else None
+
+    with source, open(part_path, 'ab' if offset else 'wb') as f, \
+            DLProgress(unit='B', unit_scale=True, miniters=1, total=total, initial=offset) as pbar:
+        for chunk in iter(lambda: source.read(chunk_size), b''):
+            f.write(chunk)
+            pbar.update(len(chunk))
+    os.replace(part_path, path)
+
+
+def _manifest(directory):
+    files = {}
+    for root, _, names in os.walk(directory):
+        for name in names:
+            path = os.path.join(root, name)
+            files[os.path.relpath(path, directory)] = {'size': os.path.getsize(path), 'sha256': _sha256(path)}
+    return files
+
+
+def _verify(directory, files, full=False):
+    """
+    :param directory: Extracted model directory
+    :param files: Manifest of the directory, see _manifest
+    :param full: Compare the SHA-256 of every file instead of only the sizes
+    :return: True if every file of the manifest is present and unchanged
+    """
+    for name, expected in files.items():
+        path = os.path.join(directory, name)
+        if not os.path.isfile(path) or os.path.getsize(path) != expected['size']:
+            return False
+        if full and _sha256(path) != expected['sha256']:
+            return False
+    return True
+
+
+def _link(source, target, files, full=False):
+    """
+    Point target at source with a symlink, falls back to a copy. A model directory at target that matches the
+    manifest of source is left in place, any other one is replaced.
+    :param source: Model directory in the cache
+    :param target: Path to provide the model at
+    :param files: Manifest of source, see _manifest
+    :param full: Compare the SHA-256 of every file of an existing directory instead of only the sizes
+    """
+    if os.path.islink(target) or os.path.isfile(target):
+        os.remove(target)
+    elif os.path.isdir(target):
+        if _verify(target, files, full=full):
+            print('Keeping the existing pre-trained vgg model in {}'.format(target))
+            return
+        print('Replacing the modified pre-trained vgg model in {}'.format(target))
+        shutil.rmtree(target)
+
+    # Left behind by an interrupted run
+    if os.path.islink(target + '.tmp') or os.path.isfile(target + '.tmp'):
+        os.remove(target + '.tmp')
+    elif os.path.isdir(target + '.tmp'):
+        shutil.rmtree(target + '.tmp')
+    try:
+        os.symlink(os.path.abspath(source), target + '.tmp')
+        os.replace(target + '.tmp', target)
+    except OSError:
+        shutil.copytree(source, target + '.tmp')
+        os.rename(target + '.tmp', target)
+
+
+def maybe_download_pretrained_vgg(data_dir, cache_dir=None, mirror=None, sha256=None, verify=False):
+    """
+    Provide the pretrained vgg model in data_dir/vgg. The model is kept in a content-addressed cache, keyed by
+    the SHA-256 of vgg.zip, and data_dir/vgg links to the cached copy. A cold start downloads the zip, resuming
+    an interrupted download, and extracts it next to the cache entry before renaming it into place, so an
+    entry is either complete or absent. Concurrent processes serialize on a lock file in the cache, the first
+    one downloads and the others reuse its result.
+    :param data_dir: Directory to provide the model in
+    :param cache_dir: Directory of the model cache, data_dir/model_cache by default
+    :param mirror: Base URL to download vgg.zip from instead of the default location, e.g. 'file:///mnt/models/'
+    :param sha256: Expected SHA-256 of vgg.zip, the download is rejected if it differs
+    :param verify: Check the SHA-256 of every cached file, not just its size. Always done for an existing model
+                   directory in data_dir when sha256 is given.
+    :return: Dict with the model path, the seconds spent, whether the cache was used and the seconds that saved
+    """
+    start = time.time()
+    cache_dir = cache_dir or os.path.join(data_dir, 'model_cache')
+    url = mirror.rstrip('/') + '/' + VGG_FILENAME if mirror else VGG_URL
     vgg_path = os.path.join(data_dir, 'vgg')
-    vgg_files = [
-        os.path.join(vgg_path, 'variables/variables.data-00000-of-00001'),
-        os.path.join(vgg_path, 'variables/variables.index'),
-        os.path.join(vgg_path, 'saved_model.pb')]
-
-    missing_vgg_files = [vgg_file for vgg_file in vgg_files if not os.path.exists(vgg_file)]
-    if missing_vgg_files:
-        # Clean vgg dir
-        if os.path.exists(vgg_path):
-            shutil.rmtree(vgg_path)
-        os.makedirs(vgg_path)
-
-        # Download vgg
-        print('Downloading pre-trained vgg model...')
-        with DLProgress(unit='B', unit_scale=True, miniters=1) as pbar:
-            urlretrieve(
-                'https://s3-us-west-1.amazonaws.com/udacity-selfdrivingcar/vgg.zip',
-                os.path.join(vgg_path, vgg_filename),
-                pbar.hook)
-
-        # Extract vgg
-        print('Extracting model...')
-        zip_ref = zipfile.ZipFile(os.path.join(vgg_path, vgg_filename), 'r')
-        zip_ref.extractall(data_dir)
-        zip_ref.close()
-
-        # Remove zip file to save space
-        os.remove(os.path.join(vgg_path, vgg_filename))
-
-
-def gen_batch_function(data_folder, image_shape):
+    os.makedirs(os.path.join(cache_dir, 'sha256'), exist_ok=True)
+    os.makedirs(os.path.join(cache_dir, 'refs'), exist_ok=True)
+    url_key = hashlib.sha1(url.encode()).hexdigest()
+
+    with file_lock(os.path.join(cache_dir, '.lock')):
+        digest = sha256
+        ref_path = os.path.join(cache_dir, 'refs', url_key)
+        if digest is None and os.path.exists(ref_path):
+            with open(ref_path) as f:
+                digest = f.read().strip()
+
+        entry = None
+        if digest:
+            entry = os.path.join(cache_dir, 'sha256', digest)
+            manifest_path = os.path.join(entry, 'manifest.json')
+            if os.path.exists(manifest_path):
+                with open(manifest_path) as f:
+                    manifest = json.load(f)
+                if not _verify(os.path.join(entry, 'vgg'), manifest['files'], full=verify):
+                    print('Cached vgg model {} is corrupt, downloading it again'.format(digest))
+                    shutil.rmtree(entry)
+                    entry = None
+            else:
+                entry = None
+
+        cached = entry is not None
+        if not cached:
+            print('Downloading pre-trained vgg model from {}...'.format(url))
+            zip_path = os.path.join(cache_dir, url_key + '.zip')
+            download_resumable(url, zip_path)
+            digest = _sha256(zip_path)
+            if sha256 and digest != sha256:
+                os.remove(zip_path)
+                raise IOError('Checksum of {} is {}, expected {}'.format(url, digest, sha256))
+
+            print('Extracting model...')
+            entry = os.path.join(cache_dir, 'sha256', digest)
+            extract_dir = entry + '.tmp-%d' % os.getpid()
+            shutil.rmtree(extract_dir, ignore_errors=True)
+            with zipfile.ZipFile(zip_path, 'r') as zip_ref:
+                zip_ref.extractall(extract_dir)
+            missing = [name for name in VGG_FILES if not os.path.exists(os.path.join(extract_dir, 'vgg', name))]
+            if missing:
+                shutil.rmtree(extract_dir)
+                raise IOError('{} is missing {}'.format(url, ', '.join(missing)))
+            manifest = {'url': url, 'files': _manifest(os.path.join(extract_dir, 'vgg')),
+                        'provision_seconds': time.time() - start}
+            with open(os.path.join(extract_dir, 'manifest.json'), 'w') as f:
+                json.dump(manifest, f, indent=2)
+            if os.path.exists(entry):
+                shutil.rmtree(entry)
+            os.rename(extract_dir, entry)
+            with open(ref_path + '.tmp', 'w') as f:
+                f.write(digest)
+            os.replace(ref_path + '.tmp', ref_path)
+            # Remove zip file to save space
+            os.remove(zip_path)
+
+        if os.path.realpath(vgg_path) != os.path.realpath(os.path.join(entry, 'vgg')):
+            # A model directory extracted by an earlier version is only kept if it matches the cache entry
+            _link(os.path.join(entry, 'vgg'), vgg_path, manifest['files'], full=verify or sha256 is not None)
+
+    elapsed = time.time() - start
+    saved = max(manifest['provision_seconds'] - elapsed, 0.) if cached else 0.
+    if cached:
+        print('Pre-trained vgg model {} from cache in {:.2f}s, {:.1f}s less than downloading it'.format(
+            digest[:12], elapsed, saved))
+    return {'path': vgg_path, 'sha256': digest, 'seconds': elapsed, 'cached': cached, 'saved_seconds': saved}
+
+
+BACKGROUND_COLOR = np.array([255, 0, 0])
+LABEL_FORMATS = ('dense', 'sparse')
+CACHE_VERSION = 2                               # Bump when the layout of the cached arrays changes
+DatasetCache = namedtuple('DatasetCache', ['names', 'images', 'labels'])
+
+
+def _training_pairs(data_folder):
+    """
+    Find all training images and their road ground truth images
+    :param data_folder: Path to folder that contains the "image_2" and "gt_image_2" folders
+    :return: Sorted list of (image_file, gt_image_file) tuples
+    """
+    image_paths = sorted(glob(os.path.join(data_folder, 'image_2', '*.png')))
+    label_paths = {
+        re.sub(r'_(lane|road)_', '_', os.path.basename(path)): path
+        for path in glob(os.path.join(data_folder, 'gt_image_2', '*_road_*.png'))}
+
+    return [(image_file, label_paths[os.path.basename(image_file)]) for image_file in image_paths]
+
+
+def _load_training_pair(image_file, gt_image_file, image_shape):
+    """
+    Decode and resize one training image and build its class index ground truth
+    :param image_file: Path to the image
+    :param gt_image_file: Path to the ground truth image
+    :param image_shape: Tuple - Shape of image
+    :return: Tuple of (image, gt_image), gt_image is uint8 with 0 for background and 1 for road pixels
+    """
+    image = scipy.misc.imresize(scipy.misc.imread(image_file), image_shape)
+    gt_image = scipy.misc.imresize(scipy.misc.imread(gt_image_file), image_shape)
+
+    gt_bg = np.all(gt_image == BACKGROUND_COLOR, axis=2)
+
+    return image, np.invert(gt_bg).astype(np.uint8)
+
+
+def one_hot(labels, num_classes=2):
+    """
+    :param labels: Class index labels of shape (..., H, W)
+    :param num_classes: Number of classes
+    :return: bool one-hot labels of shape (..., H, W, num_classes)
+    """
+    return labels[..., np.newaxis] == np.arange(num_classes, dtype=labels.dtype)
+
+
+def _fingerprint(paths):
+    """
+    Cheap fingerprint of a set of files based on their names, sizes and modification times
+    :param paths: List of file paths
+    :return: Hex digest
+    """
+    sha = hashlib.sha1()
+    for path in paths:
+        stat = os.stat(path)
+        sha.update('{}:{}:{}\n'.format(os.path.basename(path), stat.st_size, stat.st_mtime_ns).encode())
+    return sha.hexdigest()
+
+
+def preprocess_dataset(data_folder, image_shape, cache_dir):
+    """
+    Decode and resize the training data once and store it as memory-mapped .npy arrays. The cache is rebuilt
+    automatically when the source files or the image shape change.
+    :param data_folder: Path to folder that contains all the datasets
+    :param image_shape: Tuple - Shape of image
+    :param cache_dir: Directory to store the cache in
+    :return: DatasetCache of (names, images, labels), images and labels are read-only memmaps. The labels are
+             uint8 class indices of shape (N, H, W).
+    """
+    pairs = _training_pairs(data_folder)
+    fingerprint = _fingerprint([path for pair in pairs for path in pair])
+
+    folder_key = hashlib.sha1(os.path.abspath(data_folder).encode()).hexdigest()[:8]
+    prefix = os.path.join(cache_dir, 'kitti_{}_{}x{}'.format(folder_key, image_shape[0], image_shape[1]))
+    index_file = prefix + '_index.json'
+    images_file = prefix + '_images.npy'
+    labels_file = prefix + '_labels.npy'
+
+    index = None
+    if os.path.exists(index_file):
+        with open(index_file) as f:
+            index = json.load(f)
+
+    if (not index or index.get('version') != CACHE_VERSION or index['fingerprint'] != fingerprint or
+            tuple(index['image_shape']) != tuple(image_shape)):
+        print('Preprocessing {} images into cache {}...'.format(len(pairs), cache_dir))
+        os.makedirs(cache_dir, exist_ok=True)
+
+        images = np.lib.format.open_memmap(images_file + '.tmp', mode='w+', dtype=np.uint8,
+                                           shape=(len(pairs), image_shape[0], image_shape[1], 3))
+        labels = np.lib.format.open_memmap(labels_file + '.tmp', mode='w+', dtype=np.uint8,
+                                           shape=(len(pairs), image_shape[0], image_shape[1]))
+        for i, (image_file, gt_image_file) in enumerate(pairs):
+            images[i], labels[i] = _load_training_pair(image_file, gt_image_file, image_shape)
+        images.flush()
+        labels.flush()
+        del images, labels
+
+        # Write the index last so an interrupted run never leaves a valid looking cache behind
+        os.replace(images_file + '.tmp', images_file)
+        os.replace(labels_file + '.tmp', labels_file)
+        index = {'version': CACHE_VERSION,
+                 'fingerprint': fingerprint,
+                 'image_shape': list(image_shape),
+                 'names': [os.path.basename(image_file) for image_file, _ in pairs]}
+        with open(index_file + '.tmp', 'w') as f:
+            json.dump(index, f)
+        os.replace(index_file + '.tmp', index_file)
+
+    return DatasetCache(index['names'], np.load(images_file, mmap_mode='r'), np.load(labels_file, mmap_mode='r'))
+
+
+def split_training_data(data_folder, validation_fraction, seed=0):
+    """
+    Split the training images into a training and a held-out validation set, the same way on every call
+    :param data_folder: Path to folder that contains all the datasets
+    :param validation_fraction: Fraction of the images to hold out
+    :param seed: Random seed of the split
+    :return: Tuple of (training image names, validation image names)
+    """
+    names = [os.path.basename(image_file) for image_file, _ in _training_pairs(data_folder)]
+    np.random.RandomState(seed).shuffle(names)
+    validation_count = int(round(len(names) * validation_fraction))
+    return sorted(names[validation_count:]), sorted(names[:validation_count])
+
+
+def gen_batch_function(data_folder, image_shape, cache_dir=None, shuffle=True, augment=None, seed=None,
+                       names=None, label_format='dense'):
     """
     Generate function to create batches of training data
     :param data_folder: Path to folder that contains all the datasets
     :param image_shape: Tuple - Shape of image
+    :param cache_dir: Directory for the preprocessed dataset cache, None decodes the PNG files on every batch
+    :param shuffle: Shuffle the images every epoch. Unshuffled batches from the cache are served without copying
+    :param augment: Optional BatchAugmenter applied to every batch
+    :param seed: Seed for the augmentation, every batch gets its own RNG derived from (seed, epoch, batch)
+    :param names: Optional image names to restrict the batches to, see split_training_data
+    :param label_format: 'dense' for bool one-hot labels of shape (N, H, W, 2), 'sparse' for uint8 class index
+                         labels of shape (N, H, W) which take an eighth of the bytes to feed as float32 one-hot
     :return:
     """
+    assert label_format in LABEL_FORMATS, 'Unknown label format {}'.format(label_format)
+    seed = seed if seed is not None else np.random.randint(2**31)
+    epochs = count()
+
+    def batch_tasks(batch_size):
+        """
+        Create one task per batch of training data. Tasks are independent and can run on any thread.
+        :param batch_size: Batch Size
+        :return: Callables that each load and return one batch of training data
+        """
+        epoch = next(epochs)
+
+        def rng(batch_i):
+            return np.random.RandomState([seed, epoch, batch_i]) if augment else None
+
+        if cache_dir:
+            cache = preprocess_dataset(data_folder, image_shape, cache_dir)
+            order = np.arange(len(cache.names))
+            if names is not None:
+                order = order[np.isin(cache.names, names)]
+            if shuffle:
+                order = np.random.permutation(order)
+            for batch_i in range(0, len(order), batch_size):
+                # Sorting the indices within a batch keeps the reads from the memmap sequential
+                indices = np.sort(order[batch_i:batch_i+batch_size])
+                if indices[-1] - indices[0] == len(indices) - 1:
+                    batch = slice(indices[0], indices[-1] + 1)
+                else:
+                    batch = indices
+                yield partial(_load_cached_batch, cache, batch, augment, rng(batch_i), label_format)
+            return
+
+        pairs = _training_pairs(data_folder)
+        if names is not None:
+            selected = set(names)
+            pairs = [pair for pair in pairs if os.path.basename(pair[0]) in selected]
+        if shuffle:
+            random.shuffle(pairs)
+        for batch_i in range(0, len(pairs), batch_size):
+            yield partial(_load_batch, pairs[batch_i:batch_i+batch_size], image_shape, augment, rng(batch_i),
+                          label_format)
+
     def get_batches_fn(batch_size):
         """
         Create batches of training data
         :param batch_size: Batch Size
         :return: Batches of training data
         """
-        image_paths = glob(os.path.join(data_folder, 'image_2', '*.png'))
-        label_paths = {
-            re.sub(r'_(lane|road)_', '_', os.path.basename(path)): path
-            for path in glob(os.path.join(data_folder, 'gt_image_2', '*_road_*.png'))}
-        background_color = np.array([255, 0, 0])
+        for task in batch_tasks(batch_size):
+            yield task()
 
-        random.shuffle(image_paths)
-        for batch_i in range(0, len(image_paths), batch_size):
-            images = []
-            gt_images = []
-            for image_file in image_paths[batch_i:batch_i+batch_size]:
-                gt_image_file = label_paths[os.path.basename(image_file)]
+    get_batches_fn.batch_tasks = batch_tasks
+    return get_batches_fn
 
-                image = scipy.misc.imresize(scipy.misc.imread(image_file), image_shape)
-                gt_image = scipy.misc.imresize(scipy.misc.imread(gt_image_file), image_shape)
 
-                gt_bg = np.all(gt_image == background_color, axis=2)
-                gt_bg = gt_bg.reshape(*gt_bg.shape, 1)
-                gt_image = np.concatenate((gt_bg, np.invert(gt_bg)), axis=2)
+def _format_labels(images, labels, label_format):
+    return images, one_hot(labels) if label_format == 'dense' else labels
 
-                images.append(image)
-                gt_images.append(gt_image)
 
-            yield np.array(images), np.array(gt_images)
-    return get_batches_fn
+def _load_cached_batch(cache, batch, augment=None, rng=None, label_format='dense'):
+    if augment is None:
+        return _format_labels(cache.images[batch], cache.labels[batch], label_format)
+
+    # Let the augmentation gather straight from the memmap so the batch is copied only once. The one-hot labels
+    # are expanded after the gather, which then moves a single byte per pixel.
+    indices = np.arange(batch.start, batch.stop) if isinstance(batch, slice) else batch
+    return _format_labels(*augment(cache.images, cache.labels, rng, indices), label_format)
+
+
+def _load_batch(pairs, image_shape, augment=None, rng=None, label_format='dense'):
+    images = []
+    gt_images = []
+    for image_file, gt_image_file in pairs:
+        image, gt_image = _load_training_pair(image_file, gt_image_file, image_shape)
+
+        images.append(image)
+        gt_images.append(gt_image)
 
+    if augment is not None:
+        return _format_labels(*augment(np.array(images), np.array(gt_images), rng), label_format)
+    return _format_labels(np.array(images), np.array(gt_images), label_format)
 
-def gen_test_output(sess, logits, keep_prob, image_pl, data_folder, image_shape):
+
+class BatchAugmenter(object):
+    """
+    Augment whole batches of uint8 images and their labels with NumPy: random crops and scale, horizontal flips
+    and brightness/contrast jitter. Images and labels get the same geometric transform. The geometric transforms
+    are a single gather that makes the only copy of the batch, the jitter is applied in place to that copy.
+    """
+    def __init__(self, flip_prob=0.5, max_scale=1.25, brightness=0.15, contrast=0.2):
+        """
+        :param flip_prob: Probability of flipping an image horizontally
+        :param max_scale: Maximum zoom factor, a random crop of 1/scale of the image is scaled back to full size
+        :param brightness: Maximum brightness shift as a fraction of the value range
+        :param contrast: Maximum relative contrast change
+        """
+        self.flip_prob = flip_prob
+        self.max_scale = max_scale
+        self.brightness = brightness
+        self.contrast = contrast
+
+    def __call__(self, images, labels, rng, indices=None):
+        """
+        :param images: uint8 array of shape (N, H, W, 3), left unchanged
+        :param labels: Array of shape (N, H, W, ...), left unchanged
+        :param rng: np.random.RandomState
+        :param indices: Optional indices into images and labels of the samples to augment
+        :return: Tuple of augmented (images, labels)
+        """
+        if indices is None:
+            indices = np.arange(len(images))
+        size = len(indices)
+        height, width = images.shape[1:3]
+
+        # Nearest neighbour sampling grid of a random crop per image, reversed for flipped images
+        scale = rng.uniform(1., self.max_scale, size)
+        crop_height, crop_width = height / scale, width / scale
+        top = rng.uniform(0., height - crop_height)
+        left = rng.uniform(0., width - crop_width)
+        rows = (top[:, np.newaxis] + np.arange(height) * (crop_height / height)[:, np.newaxis]).astype(np.intp)
+        cols = (left[:, np.newaxis] + np.arange(width) * (crop_width / width)[:, np.newaxis]).astype(np.intp)
+        flip = rng.rand(size) < self.flip_prob
+        cols[flip] = cols[flip, ::-1]
+
+        samples = np.asarray(indices)[:, np.newaxis, np.newaxis]
+        rows, cols = rows[:, :, np.newaxis], cols[:, np.newaxis, :]
+        images = images[samples, rows, cols]
+        labels = labels[samples, rows, cols]
+
+        # Brightness and contrast as a lookup table per image
+        gain = 1. + rng.uniform(-self.contrast, self.contrast, size)
+        bias = 255. * rng.uniform(-self.brightness, self.brightness, size)
+        values = np.arange(256, dtype=np.float32) - 128.
+        luts = np.clip(values * gain[:, np.newaxis] + (128. + bias)[:, np.newaxis], 0, 255).astype(np.uint8)
+        for image, lut in zip(images, luts):
+            np.take(lut, image, out=image)
+
+        return images, labels
+
+
+class BatchPrefetcher(object):
+    """
+    Wrap a get_batches_fn so the next batches are loaded in the background while the current training step runs.
+    Batch functions created by gen_batch_function are loaded by a pool of worker threads, any other batch
+    function is drained by a single background thread.
+    """
+    _END = object()
+
+    def __init__(self, get_batches_fn, num_workers=2, prefetch=4):
+        """
+        :param get_batches_fn: Function to get batches of training data.  Call using get_batches_fn(batch_size)
+        :param num_workers: Number of threads loading batches
+        :param prefetch: Maximum number of batches loaded ahead of the consumer
+        """
+        self.get_batches_fn = get_batches_fn
+        self.num_workers = num_workers
+        self.prefetch = max(1, prefetch)
+        self._stop = threading.Event()
+        self._active = None
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.batches = 0
+        self.starved_batches = 0
+        self.starved_time = 0.
+
+    def stats(self):
+        """
+        :return: Dict with the number of batches served, how many of them the consumer had to wait for and the
+                 total time spent waiting. A high starved_time means training is input-bound.
+        """
+        return {'batches': self.batches,
+                'starved_batches': self.starved_batches,
+                'starved_time': self.starved_time}
+
+    def close(self):
+        """Stop all background loading and wait for the loading threads to exit, pending batches are discarded"""
+        self._stop.set()
+        if self._active is not None:
+            # Runs the cleanup of the generator even if the consumer left it suspended, e.g. on an exception
+            self._active.close()
+            self._active = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def __call__(self, batch_size):
+        self.close()
+        self._stop.clear()
+        if hasattr(self.get_batches_fn, 'batch_tasks'):
+            self._active = self._from_tasks(self.get_batches_fn.batch_tasks(batch_size))
+        else:
+            self._active = self._from_generator(self.get_batches_fn(batch_size))
+        return self._active
+
+    def _record(self, waited, ready):
+        self.batches += 1
+        if not ready:
+            self.starved_batches += 1
+            self.starved_time += waited
+
+    def _from_tasks(self, tasks):
+        executor = ThreadPoolExecutor(max_workers=self.num_workers)
+        pending = deque()
+        try:
+            for task in tasks:
+                pending.append(executor.submit(task))
+                if len(pending) < self.prefetch:
+                    continue
+                yield self._next_result(pending)
+                if self._stop.is_set():
+                    return
+            while pending and not self._stop.is_set():
+                yield self._next_result(pending)
+        finally:
+            for future in pending:
+                future.cancel()
+            executor.shutdown(wait=True)
+
+    def _next_result(self, pending):
+        future = pending.popleft()
+        ready = future.done()
+        start = time.time()
+        batch = future.result()
+        self._record(time.time() - start, ready)
+        return batch
+
+    def _from_generator(self, batches):
+        batch_queue = queue.Queue(maxsize=self.prefetch)
+        stop = threading.Event()
+
+        def put(item):
+            while not (stop.is_set() or self._stop.is_set()):
+                try:
+                    batch_queue.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def produce():
+            try:
+                for batch in batches:
+                    if not put(batch):
+                        return
+                put(self._END)
+            except Exception as e:
+                put(e)
+
+        thread = threading.Thread(target=produce, daemon=True)
+        thread.start()
+        try:
+            while not self._stop.is_set():
+                ready = not batch_queue.empty()
+                start = time.time()
+                item = batch_queue.get()
+                if item is self._END:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                self._record(time.time() - start, ready)
+                yield item
+        finally:
+            stop.set()
+            thread.join()
+
+
+def _test_images(data_folder, image_shape):
+    for image_file in glob(os.path.join(data_folder, 'image_2', '*.png')):
+        yield os.path.basename(image_file), scipy.misc.imresize(scipy.misc.imread(image_file), image_shape)
+
+
+def gen_test_output(sess, logits, keep_prob, image_pl, data_folder, image_shape, batch_size=8):
     """
     Generate test output using the test images
     :param sess: TF session
@@ -107,25 +698,174 @@ def gen_test_output(sess, logits, keep_prob, image_pl, data_folder, image_shape)
     :param image_pl: TF Placeholder for the image placeholder
     :param data_folder: Path to the folder that contains the datasets
     :param image_shape: Tuple - Shape of image
+    :param batch_size: Number of images per sess.run
     :return: Output for for each test image
     """
-    for image_file in glob(os.path.join(data_folder, 'image_2', '*.png')):
-        image = scipy.misc.imresize(scipy.misc.imread(image_file), image_shape)
+    engine = InferenceEngine(sess, image_pl, image_shape, logits=logits, keep_prob=keep_prob, batch_size=batch_size)
+
+    for names, images, _, masks in engine.run(_test_images(data_folder, image_shape)):
+        for name, street_im in zip(names, overlay(images, masks)):
+            yield name, street_im
+
+
+def gen_test_predictions(sess, logits, keep_prob, image_pl, data_folder, image_shape, batch_size=8):
+    """
+    Generate the road probabilities and masks of the test images
+    :param sess: TF session
+    :param logits: TF Tensor for the logits
+    :param keep_prob: TF Placeholder for the dropout keep robability
+    :param image_pl: TF Placeholder for the image placeholder
+    :param data_folder: Path to the folder that contains the datasets
+    :param image_shape: Tuple - Shape of image
+    :param batch_size: Number of images per sess.run
+    :return: Tuple of (name, road probability, bool road mask) for each test image
+    """
+    engine = InferenceEngine(sess, image_pl, image_shape, logits=logits, keep_prob=keep_prob, batch_size=batch_size)
+
+    for names, _, probabilities, masks in engine.run(_test_images(data_folder, image_shape)):
+        for name, probability, mask in zip(names, probabilities, masks):
+            yield name, probability, mask
+
+
+def gen_test_masks(sess, logits, keep_prob, image_pl, data_folder, image_shape, batch_size=8):
+    """
+    Generate the road masks of the test images
+    :param sess: TF session
+    :param logits: TF Tensor for the logits
+    :param keep_prob: TF Placeholder for the dropout keep robability
+    :param image_pl: TF Placeholder for the image placeholder
+    :param data_folder: Path to the folder that contains the datasets
+    :param image_shape: Tuple - Shape of image
+    :param batch_size: Number of images per sess.run
+    :return: Tuple of (name, bool road mask) for each test image
+    """
+    for name, _, mask in gen_test_predictions(sess, logits, keep_prob, image_pl, data_folder, image_shape,
+                                              batch_size):
+        yield name, mask
 
-        im_softmax = sess.run(
-            [tf.nn.softmax(logits)],
-            {keep_prob: 1.0, image_pl: [image]})
-        im_softmax = im_softmax[0][:, 1].reshape(image_shape[0], image_shape[1])
-        segmentation = (im_softmax > 0.5).reshape(image_shape[0], image_shape[1], 1)
-        mask = np.dot(segmentation, np.array([[0, 255, 0, 127]]))
-        mask = scipy.misc.toimage(mask, mode="RGBA")
-        street_im = scipy.misc.toimage(image)
-        street_im.paste(mask, box=None, mask=mask)
 
-        yield os.path.basename(image_file), np.array(street_im)
+def gen_tiled_test_output(sess, logits, keep_prob, image_pl, data_folder, image_shape, overlap=(32, 64),
+                          images_per_run=1):
+    """
+    Generate full resolution test output by running overlapping tiles of the test images
+    :param sess: TF session
+    :param logits: TF Tensor for the logits
+    :param keep_prob: TF Placeholder for the dropout keep robability
+    :param image_pl: TF Placeholder for the image placeholder
+    :param data_folder: Path to the folder that contains the datasets
+    :param image_shape: Tuple - Shape of a tile, the shape the network was trained on
+    :param overlap: Tuple - Minimum overlap between tiles in rows and columns, less overlap means fewer tiles
+    :param images_per_run: Number of images whose tiles are run in one sess.run
+    :return: Output for for each test image
+    """
+    for name, image, _, mask in _tiled_test_run(sess, logits, keep_prob, image_pl, data_folder, image_shape,
+                                                overlap, images_per_run):
+        yield name, overlay(image[np.newaxis], mask[np.newaxis])[0]
+
 
+def _tiled_test_run(sess, logits, keep_prob, image_pl, data_folder, image_shape, overlap, images_per_run):
+    engine = InferenceEngine(sess, image_pl, image_shape, logits=logits, keep_prob=keep_prob)
+    tiled = TiledInference(engine, overlap)
+    named_images = ((os.path.basename(image_file), scipy.misc.imread(image_file))
+                    for image_file in glob(os.path.join(data_folder, 'image_2', '*.png')))
+    return tiled.run(named_images, images_per_run)
 
-def save_inference_samples(runs_dir, data_dir, sess, image_shape, logits, keep_prob, input_image):
+
+class AsyncImageWriter(object):
+    """
+    Encode and write images on a pool of threads so disk I/O does not block the next inference step.
+    Images are written as PNG, or as raw .npy arrays with output_format='npy'.
+    """
+    def __init__(self, output_dir, num_workers=4, max_pending=32, output_format='png', compress_level=None):
+        """
+        :param output_dir: Directory to write the images to
+        :param num_workers: Number of threads encoding and writing images
+        :param max_pending: Maximum number of images queued before write() blocks
+        :param output_format: 'png' or 'npy'
+        :param compress_level: PNG zlib compression level 0-9, lower is faster and larger. None uses the default.
+        """
+        assert output_format in ('png', 'npy'), 'Unknown output format {}'.format(output_format)
+        self.output_dir = output_dir
+        self.output_format = output_format
+        self.compress_level = compress_level
+        self.max_pending = max_pending
+        self.executor = ThreadPoolExecutor(max_workers=num_workers)
+        self.pending = deque()
+        self.count = 0
+        self.start = time.time()
+
+    def _write(self, name, image):
+        path = os.path.join(self.output_dir, name)
+        if self.output_format == 'npy':
+            np.save(os.path.splitext(path)[0] + '.npy', image)
+        elif self.compress_level is None:
+            scipy.misc.imsave(path, image)
+        else:
+            Image.fromarray(image).save(path, compress_level=self.compress_level)
+
+    def write(self, name, image):
+        """
+        Queue an image for writing, blocks while max_pending images are queued
+        :param name: File name of the image, the extension is replaced by .npy for npy output
+        :param image: Array to write
+        """
+        while len(self.pending) >= self.max_pending:
+            self.pending.popleft().result()
+        self.pending.append(self.executor.submit(self._write, name, image))
+        self.count += 1
+
+    def close(self):
+        """
+        Wait for all queued images to be written
+        :return: Dict with the number of images written, the elapsed time and the throughput in images per second
+        """
+        try:
+            while self.pending:
+                self.pending.popleft().result()
+        finally:
+            self.executor.shutdown(wait=True)
+        elapsed = time.time() - self.start
+        return {'images': self.count, 'seconds': elapsed, 'images_per_second': self.count / max(elapsed, 1e-9)}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        if type is None:
+            self.stats = self.close()
+        else:
+            for future in self.pending:
+                future.cancel()
+            self.executor.shutdown(wait=True)
+
+
+MASK_CONTAINER = 'masks.bin'                    # Container file of a run saved with output_format='masks'
+
+
+def _save_mask_container(path, predictions, encoding, save_probabilities):
+    start = time.time()
+    count = 0
+    with MaskWriter(path, encoding) as writer:
+        for name, probability, mask in predictions:
+            writer.write(name, mask, probability if save_probabilities else None)
+            count += 1
+    elapsed = time.time() - start
+    return {'images': count, 'seconds': elapsed, 'images_per_second': count / max(elapsed, 1e-9)}
+
+
+def save_inference_samples(runs_dir, data_dir, sess, image_shape, logits, keep_prob, input_image,
+                           output_format='png', num_writers=4, compress_level=None, tile_overlap=None,
+                           mask_encoding='rle', save_probabilities=False):
+    """
+    Run the network on the test images and save the results in a new directory of runs_dir
+    :param output_format: 'png' for overlays, 'npy' for one raw mask file per image, or 'masks' for all masks in
+                          one MASK_CONTAINER file that mask_io.MaskReader reads by image name
+    :param num_writers: Number of threads writing png or npy files
+    :param compress_level: PNG zlib compression level 0-9, None uses the default
+    :param tile_overlap: Tuple - Tile overlap in rows and columns, segments the full resolution images when set
+    :param mask_encoding: Encoding of the masks in the container, see mask_io.MASK_ENCODINGS
+    :param save_probabilities: Also store the road probabilities, quantized to uint8, in the container
+    """
     # Make folder for current run
     output_dir = os.path.join(runs_dir, str(time.time()))
     if os.path.exists(output_dir):
@@ -134,7 +874,31 @@ def save_inference_samples(runs_dir, data_dir, sess, image_shape, logits, keep_p
 
     # Run NN on test images and save them to HD
     print('Training Finished. Saving test images to: {}'.format(output_dir))
-    image_outputs = gen_test_output(
-        sess, logits, keep_prob, input_image, os.path.join(data_dir, 'data_road/testing'), image_shape)
-    for name, image in image_outputs:
-        scipy.misc.imsave(os.path.join(output_dir, name), image)
+    data_folder = os.path.join(data_dir, 'data_road/testing')
+    if output_format == 'masks':
+        if tile_overlap:
+            predictions = ((name, probability, mask) for name, _, probability, mask in _tiled_test_run(
+                sess, logits, keep_prob, input_image, data_folder, image_shape, tile_overlap, 1))
+        else:
+            predictions = gen_test_predictions(sess, logits, keep_prob, input_image, data_folder, image_shape)
+        stats = _save_mask_container(os.path.join(output_dir, MASK_CONTAINER), predictions, mask_encoding,
+                                     save_probabilities)
+        print('Saved {images} masks in {seconds:.1f}s ({images_per_second:.1f} images/s)'.format(**stats))
+        return
+
+    if tile_overlap and output_format == 'npy':
+        # Full resolution masks
+        image_outputs = ((name, mask) for name, _, _, mask in _tiled_test_run(
+            sess, logits, keep_prob, input_image, data_folder, image_shape, tile_overlap, 1))
+    elif tile_overlap:
+        # Full resolution overlays
+        image_outputs = gen_tiled_test_output(
+            sess, logits, keep_prob, input_image, data_folder, image_shape, tile_overlap)
+    else:
+        gen_output = gen_test_masks if output_format == 'npy' else gen_test_output
+        image_outputs = gen_output(sess, logits, keep_prob, input_image, data_folder, image_shape)
+    with AsyncImageWriter(output_dir, num_workers=num_writers, output_format=output_format,
+                          compress_level=compress_level) as writer:
+        for name, image in image_outputs:
+            writer.write(name, image)
+    print('Saved {images} images in {seconds:.1f}s ({images_per_second:.1f} images/s)'.format(**writer.stats))
@@ -0,0 +1,324 @@
+import re
+import math
+from collections import defaultdict
+
+import numpy as np
+import tensorflow as tf
+
+OVERLAY_COLOR = np.array([0, 255, 0], dtype=np.uint32)     # Color of the road overlay
+OVERLAY_ALPHA = 127                                          # Opacity of the road overlay, 0-255
+OUTPUT_NAMES = ['logits', 'road_probability', 'segmentation']  # Output ops of an exported model
+FROZEN_MODEL_PATH = './models/P2-frozen.pb'                  # Default path of "python main.py export"
+
+
+def overlay(images, masks, color=OVERLAY_COLOR, alpha=OVERLAY_ALPHA):
+    """
+    Blend a colored mask into a batch of images. Produces the same pixels as pasting an RGBA mask with PIL.
+    :param images: uint8 array of shape (N, H, W, 3)
+    :param masks: bool array of shape (N, H, W)
+    :param color: RGB color of the overlay
+    :param alpha: Opacity of the overlay, 0-255
+    :return: uint8 array of shape (N, H, W, 3)
+    """
+    mask_alpha = masks[..., np.newaxis].astype(np.uint32) * alpha
+    blend = images.astype(np.uint32) * (255 - mask_alpha) + color * mask_alpha + 128
+    return (((blend >> 8) + blend) >> 8).astype(np.uint8)
+
+
+def batched(items, batch_size):
+    """
+    Group items from an iterable into lists of batch_size items, the last list may be shorter
+    :param items: Iterable
+    :param batch_size: Number of items per list
+    :return: Generator of lists
+    """
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+class InferenceEngine(object):
+    """
+    Run a trained FCN on batches of images. The softmax, threshold and mask ops are added to the graph once when
+    the engine is created, so repeated predictions do not grow the graph.
+    """
+    def __init__(self, sess, image_pl, image_shape, logits=None, road_probability=None, segmentation=None,
+                 keep_prob=None, batch_size=8, threshold=0.5, profiler=None):
+        """
+        :param sess: TF session
+        :param image_pl: TF Placeholder for the image placeholder
+        :param image_shape: Tuple - Shape of image
+        :param logits: TF Tensor for the logits, either (N*H*W, num_classes) or (N, H, W, num_classes)
+        :param road_probability: TF Tensor of shape (N, H, W) for the road probability, used instead of logits
+        :param segmentation: TF Tensor of shape (N, H, W) with the class index of every pixel, used instead of
+                             thresholding the road probability
+        :param keep_prob: TF Placeholder for the dropout keep probability, None if the graph has no dropout
+        :param batch_size: Number of images per sess.run
+        :param threshold: Road probability above which a pixel is classified as road
+        :param profiler: Optional profiling.StepProfiler to time and trace every sess.run with
+        """
+        self.sess = sess
+        self.session_run = profiler.wrap(sess) if profiler else sess.run
+        self.image_pl = image_pl
+        self.image_shape = image_shape
+        self.keep_prob = keep_prob
+        self.batch_size = batch_size
+
+        with sess.graph.as_default(), tf.name_scope('inference'):
+            if logits is not None:
+                num_classes = logits.get_shape().as_list()[-1]
+                logits = tf.reshape(logits, (-1, image_shape[0], image_shape[1], num_classes))
+            if road_probability is None:
+                road_probability = tf.nn.softmax(logits)[..., 1]
+            if segmentation is None:
+                segmentation = tf.greater(road_probability, threshold)
+            else:
+                segmentation = tf.cast(segmentation, tf.bool)
+            self.logits = logits
+            self.road_probability = road_probability
+            self.segmentation = segmentation
+
+    def feed_dict(self, images):
+        feed_dict = {self.image_pl: images}
+        if self.keep_prob is not None:
+            feed_dict[self.keep_prob] = 1.0
+        return feed_dict
+
+    def predict(self, images):
+        """
+        Run one batch of images through the network
+        :param images: uint8 array of shape (N, H, W, 3)
+        :return: Tuple of (road probabilities (N, H, W), bool road masks (N, H, W))
+        """
+        return self.session_run([self.road_probability, self.segmentation], self.feed_dict(images))
+
+    def run(self, named_images):
+        """
+        Run named images through the network in batches of batch_size
+        :param named_images: Iterable of (name, image) tuples
+        :return: Generator of (names, images, road probabilities, road masks) per batch
+        """
+        for batch in batched(named_images, self.batch_size):
+            names = [name for name, _ in batch]
+            images = np.array([image for _, image in batch])
+            probabilities, masks = self.predict(images)
+            yield names, images, probabilities, masks
+
+
+def tile_offsets(length, tile, overlap):
+    """
+    Start offsets of tiles of size tile that cover length with at least overlap pixels between neighbours
+    :param length: Size of the image along one axis
+    :param tile: Size of a tile along the same axis
+    :param overlap: Minimum overlap between neighbouring tiles
+    :return: List of offsets
+    """
+    if length <= tile:
+        return [0]
+    count = int(math.ceil((length - tile) / float(max(tile - overlap, 1)))) + 1
+    return [int(round(offset)) for offset in np.linspace(0, length - tile, count)]
+
+
+def blend_weights(tile_shape):
+    """
+    Weights that fall off linearly towards the tile borders, so overlapping tiles blend smoothly
+    :param tile_shape: Tuple - Shape of a tile
+    :return: float32 array of shape tile_shape
+    """
+    ramps = [np.minimum(np.arange(1, size + 1), np.arange(size, 0, -1)).astype(np.float32) for size in tile_shape]
+    return np.outer(ramps[0] / ramps[0].max(), ramps[1] / ramps[1].max())
+
+
+def softmax(logits):
+    exp = np.exp(logits - logits.max(axis=-1, keepdims=True))
+    return exp / exp.sum(axis=-1, keepdims=True)
+
+
+class TiledInference(object):
+    """
+    Segment full resolution images by cutting them into overlapping tiles of the network input size. The tiles of
+    one or more images are run in a single sess.run and their logits are blended with weights that favour the
+    tile centres. More overlap gives smoother masks at the cost of more tiles per image.
+    """
+    def __init__(self, engine, overlap=(32, 64), threshold=0.5):
+        """
+        :param engine: InferenceEngine with logits, its image_shape is the tile shape
+        :param overlap: Tuple - Minimum overlap between neighbouring tiles in rows and columns
+        :param threshold: Road probability above which a pixel is classified as road
+        """
+        self.engine = engine
+        self.tile_shape = engine.image_shape
+        self.overlap = overlap
+        self.threshold = threshold
+        self.weights = blend_weights(self.tile_shape)
+
+    def tiles(self, image_shape):
+        """
+        :param image_shape: Tuple - Shape of a full resolution image
+        :return: List of (top, left) tile offsets
+        """
+        return [(top, left)
+                for top in tile_offsets(image_shape[0], self.tile_shape[0], self.overlap[0])
+                for left in tile_offsets(image_shape[1], self.tile_shape[1], self.overlap[1])]
+
+    def predict(self, images):
+        """
+        Segment full resolution images, all their tiles are run in one sess.run
+        :param images: List of uint8 arrays of shape (H, W, 3), the images may differ in size
+        :return: Tuple of lists (road probabilities (H, W), bool road masks (H, W)) per image
+        """
+        tile_height, tile_width = self.tile_shape
+        padded, tiles, owners = [], [], []
+        for i, image in enumerate(images):
+            # Images smaller than a tile are padded up to the tile size
+            pad = ((0, max(tile_height - image.shape[0], 0)), (0, max(tile_width - image.shape[1], 0)), (0, 0))
+            image = np.pad(image, pad, mode='edge') if any(p[1] for p in pad) else image
+            padded.append(image)
+            for top, left in self.tiles(image.shape):
+                tiles.append(image[top:top+tile_height, left:left+tile_width])
+                owners.append((i, top, left))
+
+        logits = self.engine.session_run(self.engine.logits, self.engine.feed_dict(np.array(tiles)))
+
+        blended = [np.zeros(image.shape[:2] + (logits.shape[-1],), np.float32) for image in padded]
+        weight_sums = [np.zeros(image.shape[:2], np.float32) for image in padded]
+        for tile_logits, (i, top, left) in zip(logits, owners):
+            blended[i][top:top+tile_height, left:left+tile_width] += tile_logits * self.weights[..., np.newaxis]
+            weight_sums[i][top:top+tile_height, left:left+tile_width] += self.weights
+
+        probabilities, masks = [], []
+        for image, image_logits, weight_sum in zip(images, blended, weight_sums):
+            height, width = image.shape[:2]
+            image_logits = image_logits[:height, :width] / weight_sum[:height, :width, np.newaxis]
+            road_probability = softmax(image_logits)[..., 1]
+            probabilities.append(road_probability)
+            masks.append(road_probability > self.threshold)
+        return probabilities, masks
+
+    def run(self, named_images, images_per_run=1):
+        """
+        Segment named full resolution images
+        :param named_images: Iterable of (name, image) tuples
+        :param images_per_run: Number of images whose tiles are batched into one sess.run
+        :return: Generator of (name, image, road probability, road mask) per image
+        """
+        for batch in batched(named_images, images_per_run):
+            images = [image for _, image in batch]
+            probabilities, masks = self.predict(images)
+            for (name, image), probability, mask in zip(batch, probabilities, masks):
+                yield name, image, probability, mask
+
+
+def add_output_ops(last_layer):
+    """
+    Add the named output ops of an exported model
+    :param last_layer: TF Tensor of shape (N, H, W, num_classes) for the last layer of the network
+    :return: Tuple of Tensors (logits, road_probability, segmentation)
+    """
+    logits = tf.identity(last_layer, name='logits')
+    road_probability = tf.identity(tf.nn.softmax(logits)[..., 1], name='road_probability')
+    segmentation = tf.cast(tf.argmax(logits, axis=3), tf.uint8, name='segmentation')
+    return logits, road_probability, segmentation
+
+
+def _strip_dropout(graph_def):
+    """
+    Bypass every tf.nn.dropout block in a GraphDef, consumers of a dropout block read its input directly. Blocks
+    are recognised by a name scope "dropout" or "dropout_N" holding the random mask ops, which matches both the
+    Floor based and the GreaterEqual based implementations of tf.nn.dropout. The input of a block is the tensor
+    its Shape op reads.
+    :param graph_def: GraphDef
+    :return: New GraphDef
+    """
+    scopes = defaultdict(dict)
+    for node in graph_def.node:
+        scope, _, _ = node.name.rpartition('/')
+        if re.match(r'dropout(_\d+)?$', scope.rpartition('/')[2]):
+            scopes[scope][node.op] = node
+
+    dropout_inputs = {scope: ops['Shape'].input[0] for scope, ops in scopes.items()
+                      if 'Shape' in ops and ('Floor' in ops or 'GreaterEqual' in ops)}
+
+    output = tf.GraphDef()
+    output.CopyFrom(graph_def)
+    for node in output.node:
+        if any(node.name.startswith(scope + '/') for scope in dropout_inputs):
+            # Inside a block that is bypassed
+            continue
+        for i, input_name in enumerate(node.input):
+            scope = input_name.lstrip('^').rpartition('/')[0]
+            if scope not in dropout_inputs:
+                continue
+            if input_name.startswith('^'):
+                node.input[i] = '^' + dropout_inputs[scope].split(':')[0]
+            else:
+                node.input[i] = dropout_inputs[scope]
+    return output
+
+
+def freeze_graph(sess, input_name='image_input', output_names=OUTPUT_NAMES):
+    """
+    Freeze the variables of a session into an inference-only GraphDef. Dropout is removed, training ops are
+    stripped and constant subgraphs are folded.
+    :param sess: TF session with the trained variables
+    :param input_name: Name of the image placeholder
+    :param output_names: Names of the output ops
+    :return: GraphDef
+    """
+    graph_def = tf.graph_util.convert_variables_to_constants(sess, sess.graph.as_graph_def(), output_names)
+    graph_def = _strip_dropout(graph_def)
+    graph_def = tf.graph_util.remove_training_nodes(graph_def, protected_nodes=output_names)
+    graph_def = tf.graph_util.extract_sub_graph(graph_def, output_names)
+
+    try:
+        from tensorflow.tools.graph_transforms import TransformGraph
+    except ImportError:
+        return graph_def
+    return TransformGraph(graph_def, [input_name], output_names,
+                          ['fold_constants(ignore_errors=true)', 'fold_batch_norms', 'strip_unused_nodes',
+                           'sort_by_execution_order'])
+
+
+def load_graph_def(path):
+    graph_def = tf.GraphDef()
+    with open(path, 'rb') as f:
+        graph_def.ParseFromString(f.read())
+    return graph_def
+
+
+def engine_from_graph_def(graph_def, image_shape, batch_size=8, config=None):
+    """
+    Create an inference engine with its own graph and session from a frozen GraphDef
+    :param graph_def: GraphDef created by freeze_graph
+    :param image_shape: Tuple - Shape of image
+    :param batch_size: Number of images per sess.run
+    :param config: Optional tf.ConfigProto for the session
+    :return: InferenceEngine
+    """
+    graph = tf.Graph()
+    with graph.as_default():
+        tf.import_graph_def(graph_def, name='')
+    sess = tf.Session(graph=graph, config=config)
+
+    return InferenceEngine(sess, graph.get_tensor_by_name('image_input:0'), image_shape,
+                           logits=graph.get_tensor_by_name('logits:0'),
+                           road_probability=graph.get_tensor_by_name('road_probability:0'),
+                           segmentation=graph.get_tensor_by_name('segmentation:0'),
+                           batch_size=batch_size)
+
+
+def load_frozen_model(path, image_shape, batch_size=8, config=None):
+    """
+    Load a model exported with "python main.py export". Only needs this module, not the training code.
+    :param path: Path to the frozen .pb file
+    :param image_shape: Tuple - Shape of image
+    :param batch_size: Number of images per sess.run
+    :param config: Optional tf.ConfigProto for the session
+    :return: InferenceEngine
+    """
+    return engine_from_graph_def(load_graph_def(path), image_shape, batch_size, config)
@@ -1,43 +1,144 @@
 import os.path
+import time
+import argparse
+from collections import namedtuple
+from functools import partial
+import numpy as np
 import tensorflow as tf
 import helper
+import inference
+import parallel
+import metrics
+import profiling
+from checkpoint import CheckpointManager
 import warnings
 from distutils.version import LooseVersion
 import project_tests as tests
 
 # Constants
 MODEL_SAVE_PATH = "./models"                        # Filename of the TensorFlow model
+FROZEN_MODEL_PATH = inference.FROZEN_MODEL_PATH     # Inference-only graph written by "python main.py export"
 EPOCHS = 15                                         # Number of epochs
 BATCH_SIZE = 10                                     # Reduce this depending on amount of RAM available
+ACCUMULATION_STEPS = 1                              # Batches per weight update, the effective batch size is the product
+REPORT_MEMORY = True                                # Print peak memory usage per epoch to help size BATCH_SIZE
 DROPOUT_KEEP_PROB = 0.8
+LOADER_WORKERS = 2                                  # Threads loading training batches in the background
+PREFETCH_BATCHES = 4                                # Batches loaded ahead of the training step
+AUGMENT = True                                      # Random crops, flips and brightness/contrast jitter
+AUGMENT_SEED = 0
+LABEL_FORMAT = 'sparse'                             # uint8 class index labels, 'dense' feeds float32 one-hot labels
 LEARNING_RATE = 0.001                               # Initial learning rate
 DATA_PATH = './data'
+VGG_CACHE_PATH = DATA_PATH + '/model_cache'         # Content-addressed cache of the pretrained VGG, can be shared
+VGG_MIRROR = None                                   # Base URL of vgg.zip instead of the default, e.g. 'file:///models/'
+DATA_CACHE_PATH = './data/cache'                     # Preprocessed training data, rebuilt when the data changes
 RUNS_PATH = './runs'
+RESUME_TRAINING = False                             # Continue from the latest checkpoint in MODEL_SAVE_PATH
+KEEP_LAST_CHECKPOINTS = 3
+KEEP_BEST_CHECKPOINTS = 1
+DATA_PARALLEL_REPLICAS = 1                          # Replicas averaging their gradients, 1 trains in a single session
+THREADS_PER_REPLICA = None                          # Intra-op threads per replica, None splits the CPU cores evenly
+VALIDATION_FRACTION = 0.1                           # Training images held out to evaluate after every epoch
+TILE_OVERLAP = None                                 # (rows, cols) to segment test images at full resolution in tiles
+SAMPLE_OUTPUT_FORMAT = 'png'                        # 'png' overlays, or 'masks' for one compact mask container per run
+PROFILE_PATH = None                                 # Directory for step timings and Chrome traces, None disables it
+PROFILE_STEPS = (10, 100)                           # Steps to trace, of training and of the validation inference
 NUM_CLASSES = 2
 
 
+_savers = {}
+
+
+def _saver(graph):
+    '''One Saver per graph, so saving every epoch does not keep adding save ops to the graph'''
+    if graph not in _savers:
+        with graph.as_default():
+            _savers[graph] = tf.train.Saver(max_to_keep=None)
+    return _savers[graph]
+
+
 def save_model(sess, epoch):
     '''Save TensorFlow model variables to disk, the current epoch becomes part of the name'''
-    saver = tf.train.Saver()
-    save_path = saver.save(sess, MODEL_SAVE_PATH + '/P2-epoch' + str(epoch) + '.ckpt')
+    save_path = _saver(sess.graph).save(sess, MODEL_SAVE_PATH + '/P2-epoch' + str(epoch) + '.ckpt')
     print("Model saved in file: %s" % save_path)
 
 
 def load_model(sess, epoch=EPOCHS):
     '''Load previously saved TensorFlow model variables of a particular epoch'''
-    saver = tf.train.Saver()
-    saver.restore(sess, MODEL_SAVE_PATH + '/P2-epoch' + str(epoch) + '.ckpt')
-
-
-# Check TensorFlow Version
-assert LooseVersion(tf.__version__) >= LooseVersion('1.0'), 'Please use TensorFlow version 1.0 or newer.  You are using {}'.format(tf.__version__)
-print('TensorFlow Version: {}'.format(tf.__version__))
-
-# Check for a GPU
-if not tf.test.gpu_device_name():
-    warnings.warn('No GPU found. Please use a GPU to train your neural network.')
-else:
-    print('Default GPU Device: {}'.format(tf.test.gpu_device_name()))
+    _saver(sess.graph).restore(sess, MODEL_SAVE_PATH + '/P2-epoch' + str(epoch) + '.ckpt')
+
+
+def check_environment():
+    '''Check the TensorFlow version and look for a GPU'''
+    # Check TensorFlow Version
+    assert LooseVersion(tf.__version__) >= LooseVersion('1.0'), 'Please use TensorFlow version 1.0 or newer.  You are using {}'.format(tf.__version__)
+    print('TensorFlow Version: {}'.format(tf.__version__))
+
+    # Check for a GPU
+    if not tf.test.gpu_device_name():
+        warnings.warn('No GPU found. Please use a GPU to train your neural network.')
+    else:
+        print('Default GPU Device: {}'.format(tf.test.gpu_device_name()))
+
+
+def self_check():
+    '''Check the environment and run the project tests. Importing this module does neither.'''
+    import video
+    import serve
+    import quantize
+    import mask_io
+    import benchmark
+
+    check_environment()
+    tests.test_load_vgg(load_vgg, tf)
+    tests.test_layers(layers)
+    tests.test_optimize(optimize)
+    tests.test_preprocess_dataset(helper.preprocess_dataset, helper.gen_batch_function,
+                                  benchmark.write_synthetic_kitti)
+    tests.test_batch_prefetcher(helper.BatchPrefetcher)
+    tests.test_async_image_writer(helper.AsyncImageWriter)
+    tests.test_batch_augmenter(helper.BatchAugmenter, helper.gen_batch_function, benchmark.write_synthetic_kitti)
+    tests.test_sparse_cross_entropy(cross_entropy, helper.one_hot)
+    tests.test_metrics(metrics.ConfusionMatrix, metrics.road_mask, metrics.evaluate)
+    tests.test_accumulate_gradients(accumulate_gradients)
+    tests.test_data_parallel(parallel.LocalCluster, parallel.vgg_encoder, parallel.build_replicas, layers,
+                             cross_entropy)
+    # tests.test_train_nn(train_nn)
+    tests.test_overlay(inference.overlay)
+    tests.test_segment_stream(video.segment_stream, video.synthetic_frames, inference.InferenceEngine)
+    tests.test_tiled_inference(inference.TiledInference, inference.tile_offsets, inference.InferenceEngine)
+    tests.test_freeze_graph(inference.freeze_graph, inference.add_output_ops, inference.engine_from_graph_def)
+    tests.test_quantize(quantize.convert, inference.freeze_graph, inference.add_output_ops,
+                        inference.engine_from_graph_def)
+    tests.test_serve(serve.SegmentationServer, serve.DynamicBatcher, inference.InferenceEngine, mask_io.rle_decode,
+                     mask_io.png_decode)
+    tests.test_mask_container(mask_io.MaskWriter, mask_io.MaskReader, mask_io.MASK_ENCODINGS)
+    tests.test_vgg_provisioning(helper.maybe_download_pretrained_vgg)
+    tests.test_step_profiler(profiling.StepProfiler, inference.InferenceEngine)
+    tests.test_checkpoint_manager(CheckpointManager)
+
+
+def max_tensor_bytes_op():
+    '''Op returning the peak number of bytes allocated for tensors, None if the installed TensorFlow lacks it'''
+    try:
+        from tensorflow.contrib.memory_stats import MaxBytesInUse
+        return MaxBytesInUse()
+    except (ImportError, AttributeError):
+        return None
+
+
+def print_memory_usage(sess, max_bytes_in_use=None):
+    '''Print the peak resident set size of the process and, if available, the peak tensor memory'''
+    peak_rss = helper.peak_rss_mb()
+    message = 'Peak RSS %.0f MB' % peak_rss if peak_rss is not None else 'Peak RSS not available'
+    if max_bytes_in_use is not None:
+        try:
+            message += ', peak tensor memory %.0f MB' % (sess.run(max_bytes_in_use) / 2**20)
+        except tf.errors.OpError:
+            # Only registered for some devices
+            pass
+    print(message)
 
 
 def load_vgg(sess, vgg_path):
@@ -60,8 +161,6 @@ def load_vgg(sess, vgg_path):
 
     return input_image, keep_prob, vgg_layer3_out, vgg_layer4_out, vgg_layer7_out
 
-tests.test_load_vgg(load_vgg, tf)
-
 
 def layer_1x1_conv(layer, num_classes, layer_name):
     return tf.layers.conv2d(layer, num_classes, 1,
@@ -95,7 +194,6 @@ def layers(vgg_layer3_out, vgg_layer4_out, vgg_layer7_out, num_classes):
     :param num_classes: Number of classes to classify
     :return: The Tensor for the last layer of output
     """
-
     # 1x1 convolution
     vgg_layer7_1x1 = layer_1x1_conv(vgg_layer7_out, num_classes, 'vgg_layer7')
 
@@ -122,45 +220,136 @@ def layers(vgg_layer3_out, vgg_layer4_out, vgg_layer7_out, num_classes):
 
     return last
 
-tests.test_layers(layers)
+
+def cross_entropy(nn_last_layer, correct_label, num_classes):
+    """
+    Build the TensorFLow loss operation.
+    :param nn_last_layer: TF Tensor of the last layer in the neural network
+    :param correct_label: TF Placeholder for the correct label image, either one-hot of shape (N, H, W, num_classes)
+                          or of an integer type with the class index of every pixel, of shape (N, H, W)
+    :param num_classes: Number of classes to classify
+    :return: Tuple of (logits, cross_entropy_loss)
+    """
+
+    logits = tf.reshape(nn_last_layer, (-1, num_classes))
+
+    if correct_label.dtype.is_integer:
+        labels = tf.cast(tf.reshape(correct_label, [-1]), tf.int32)
+        cross_entropy_loss = tf.reduce_mean(tf.nn.sparse_softmax_cross_entropy_with_logits(logits = logits,
+                                                                                           labels = labels))
+    else:
+        cross_entropy_loss = tf.reduce_mean(tf.nn.softmax_cross_entropy_with_logits(logits = logits,
+                                                                                    labels = correct_label))
+
+    return logits, cross_entropy_loss
+
+
+def label_placeholder(image_shape, num_classes, label_format, name='correct-label'):
+    """
+    :param image_shape: Tuple - Shape of image
+    :param num_classes: Number of classes to classify
+    :param label_format: 'dense' or 'sparse', see helper.gen_batch_function
+    :param name: Name of the placeholder
+    :return: TF Placeholder for the correct label image
+    """
+    if label_format == 'sparse':
+        return tf.placeholder(tf.uint8, (None, image_shape[0], image_shape[1]), name=name)
+    return tf.placeholder(tf.float32, (None, image_shape[0], image_shape[1], num_classes), name=name)
+
+
+GradientAccumulation = namedtuple('GradientAccumulation', ['accumulate_op', 'apply_op', 'steps'])
 
 
-def optimize(nn_last_layer, correct_label, learning_rate, num_classes):
+def accumulate_gradients(optimizer, loss, steps):
+    """
+    Build ops that add the gradients of a micro-batch to accumulators and apply their average in one update.
+    :param optimizer: TF Optimizer
+    :param loss: TF Tensor for the loss of a micro-batch
+    :param steps: Number of micro-batches per update. Micro-batches whose gradients are not finite are left out
+                  of the average.
+    :return: GradientAccumulation
+    """
+    grads_and_vars = optimizer.compute_gradients(loss)
+    grads_and_vars = [(tf.convert_to_tensor(grad), var) for grad, var in grads_and_vars if grad is not None]
+    finite = tf.reduce_all([tf.reduce_all(tf.is_finite(grad)) for grad, _ in grads_and_vars])
+
+    # Local variables, so the accumulators are initialized by train_nn but never checkpointed
+    with tf.variable_scope('gradient_accumulation'):
+        accumulators = [tf.Variable(tf.zeros(var.get_shape(), var.dtype.base_dtype), trainable=False,
+                                    collections=[tf.GraphKeys.LOCAL_VARIABLES], name='accumulator')
+                        for _, var in grads_and_vars]
+        count = tf.Variable(0., trainable=False, collections=[tf.GraphKeys.LOCAL_VARIABLES], name='count')
+
+    accumulate_op = tf.group(count.assign_add(tf.cast(finite, tf.float32)),
+                             *[accumulator.assign_add(tf.where(finite, grad, tf.zeros_like(grad)))
+                               for accumulator, (grad, _) in zip(accumulators, grads_and_vars)])
+
+    def apply():
+        with tf.control_dependencies([optimizer.apply_gradients(
+                [(accumulator / count, var) for accumulator, (_, var) in zip(accumulators, grads_and_vars)])]):
+            return tf.constant(True)
+
+    # Skip the update when no micro-batch had finite gradients, Adam would still move the weights on zero gradients.
+    # The optimizer creates its slot variables outside the cond.
+    applied = tf.cond(count > 0., apply, lambda: tf.constant(False))
+    with tf.control_dependencies([applied]):
+        apply_op = tf.group(count.assign(0.), *[accumulator.assign(tf.zeros_like(accumulator))
+                                                for accumulator in accumulators])
+
+    return GradientAccumulation(accumulate_op, apply_op, steps)
+
+
+def optimize(nn_last_layer, correct_label, learning_rate, num_classes, accumulation_steps=1):
     """
     Build the TensorFLow loss and optimizer operations.
     :param nn_last_layer: TF Tensor of the last layer in the neural network
     :param correct_label: TF Placeholder for the correct label image
     :param learning_rate: TF Placeholder for the learning rate
     :param num_classes: Number of classes to classify
-    :return: Tuple of (logits, train_op, cross_entropy_loss)
+    :param accumulation_steps: Number of micro-batches averaged into one update
+    :return: Tuple of (logits, train_op, cross_entropy_loss), train_op is a GradientAccumulation when
+             accumulation_steps > 1
     """
 
-    logits = tf.reshape(nn_last_layer, (-1, num_classes))
-
-    cross_entropy_loss = tf.reduce_mean(tf.nn.softmax_cross_entropy_with_logits(logits = logits,
-                                                                                labels = correct_label))
+    logits, cross_entropy_loss = cross_entropy(nn_last_layer, correct_label, num_classes)
 
-    optimizer = tf.train.AdamOptimizer(learning_rate).minimize(cross_entropy_loss)
+    if accumulation_steps > 1:
+        optimizer = accumulate_gradients(tf.train.AdamOptimizer(learning_rate), cross_entropy_loss,
+                                         accumulation_steps)
+    else:
+        optimizer = tf.train.AdamOptimizer(learning_rate).minimize(cross_entropy_loss)
 
     return logits, optimizer, cross_entropy_loss
 
-tests.test_optimize(optimize)
+
+def shard_feed(placeholders, value):
+    '''Feed dict for one placeholder, or for a list of replica placeholders that each get a shard of the value'''
+    if isinstance(placeholders, (list, tuple)):
+        return dict(zip(placeholders, np.array_split(value, len(placeholders))))
+    return {placeholders: value}
 
 
 def train_nn(sess, epochs, batch_size, get_batches_fn, train_op, cross_entropy_loss, input_image,
-             correct_label, keep_prob, learning_rate):
+             correct_label, keep_prob, learning_rate, report_memory=False, checkpoint_manager=None,
+             resume=False, evaluate_fn=None, profiler=None):
     """
     Train neural network and print out the loss during training.
     :param sess: TF Session
     :param epochs: Number of epochs
     :param batch_size: Batch size
     :param get_batches_fn: Function to get batches of training data.  Call using get_batches_fn(batch_size)
-    :param train_op: TF Operation to train the neural network
+    :param train_op: TF Operation to train the neural network, or a GradientAccumulation
     :param cross_entropy_loss: TF Tensor for the amount of loss
-    :param input_image: TF Placeholder for input image
-    :param correct_label: TF Placeholder for label image
+    :param input_image: TF Placeholder for input image, or a list with the placeholder of every replica
+    :param correct_label: TF Placeholder for label image, or a list with the placeholder of every replica
     :param keep_prob: TF Placeholder for dropout keep probability
     :param learning_rate: TF Placeholder for learning rate
+    :param report_memory: Print the peak memory usage after every epoch
+    :param checkpoint_manager: CheckpointManager to save every epoch with, save_model is used if None
+    :param resume: Continue from the latest checkpoint of checkpoint_manager
+    :param evaluate_fn: Function returning a dict of validation metrics, called after every epoch. Its 'iou' is
+                        the checkpoint metric, the mean training loss is used without it.
+    :param profiler: Optional profiling.StepProfiler to time and trace the training steps with
     """
     # log_dir = '/tmp/tf/adl/logs'
     # if tf.gfile.Exists(log_dir):
@@ -171,69 +360,207 @@ def train_nn(sess, epochs, batch_size, get_batches_fn, train_op, cross_entropy_l
         sess.run(tf.global_variables_initializer())
         sess.run(tf.local_variables_initializer())
 
-        image_batches = []
-        for i in range(epochs):
+        max_bytes_in_use = max_tensor_bytes_op() if report_memory else None
+
+        start_epoch = 0
+        if checkpoint_manager and resume:
+            start_epoch = checkpoint_manager.restore_latest(sess)
+            if start_epoch >= epochs:
+                warnings.warn('The latest checkpoint is of epoch {}, there is nothing left to train for {} epochs. '
+                              'Increase EPOCHS or set RESUME_TRAINING = False to train from scratch.'.format(
+                                  start_epoch - 1, epochs))
+
+        run = profiler.wrap(sess) if profiler else sess.run
+        for i in range(start_epoch, epochs):
+            epoch_start = time.time()
+            if profiler:
+                profiler.mark()
             batch = 0
+            total_loss = 0.
             print('Epoch %d' % (i))
             for image, label in get_batches_fn(batch_size):
-                image_batches.append((image, label))
+                if isinstance(input_image, (list, tuple)) and len(image) < len(input_image):
+                    # Too few images left to give every replica a shard
+                    continue
                 batch += 1
 
-                loss, _ = sess.run([cross_entropy_loss, train_op],
-                                   feed_dict={input_image: image,
-                                   correct_label: label,
-                                   learning_rate: LEARNING_RATE,
-                                   keep_prob: DROPOUT_KEEP_PROB})
+                feed_dict = {learning_rate: LEARNING_RATE,
+                             keep_prob: DROPOUT_KEEP_PROB}
+                feed_dict.update(shard_feed(input_image, image))
+                feed_dict.update(shard_feed(correct_label, label))
+                if isinstance(train_op, GradientAccumulation):
+                    loss, _ = run([cross_entropy_loss, train_op.accumulate_op], feed_dict=feed_dict)
+                    if batch % train_op.steps == 0:
+                        sess.run(train_op.apply_op)
+                else:
+                    loss, _ = run([cross_entropy_loss, train_op], feed_dict=feed_dict)
 
                 print ('Batch %4d cross_entropy_loss %.03f' % (batch, loss))
+                total_loss += loss
+
+            if isinstance(train_op, GradientAccumulation) and batch % train_op.steps:
+                # Apply what is left of the last update of the epoch
+                sess.run(train_op.apply_op)
 
+            if hasattr(get_batches_fn, 'stats'):
+                stats = get_batches_fn.stats()
+                print('Input pipeline: waited %.2fs for %d of %d batches' %
+                      (stats['starved_time'], stats['starved_batches'], stats['batches']))
+                get_batches_fn.reset_stats()
 
-            save_model(sess, i)
+            metric = total_loss / max(batch, 1)
+            if evaluate_fn:
+                evaluation_start = time.time()
+                results = evaluate_fn()
+                evaluation_time = time.time() - evaluation_start
+                print('Validation IoU %.3f precision %.3f recall %.3f accuracy %.3f (%.1fs, %.0f%% of the epoch)' %
+                      (results['iou'], results['precision'], results['recall'], results['accuracy'],
+                       evaluation_time, 100. * evaluation_time / (time.time() - epoch_start)))
+                metric = results['iou']
 
-# tests.test_train_nn(train_nn)
+            if checkpoint_manager:
+                stall = checkpoint_manager.save(sess, i, metric=metric)
+                print('Checkpoint of epoch %d stalled training for %.2fs' % (i, stall))
+            else:
+                save_model(sess, i)
+
+            if report_memory:
+                print_memory_usage(sess, max_bytes_in_use)
+
+        if checkpoint_manager:
+            checkpoint_manager.wait()
 
 
 def run():
+    if DATA_PARALLEL_REPLICAS > 1 and ACCUMULATION_STEPS > 1:
+        raise ValueError('ACCUMULATION_STEPS is not supported with DATA_PARALLEL_REPLICAS > 1, the replicas apply '
+                         'their averaged gradients every batch')
+    self_check()
+
     image_shape = (160, 576)
     print("Load data")
     tests.test_for_kitti_dataset(DATA_PATH)
 
     # Download pretrained vgg model
     print("Load VGG")
-    helper.maybe_download_pretrained_vgg(DATA_PATH)
+    helper.maybe_download_pretrained_vgg(DATA_PATH, cache_dir=VGG_CACHE_PATH, mirror=VGG_MIRROR)
 
     # OPTIONAL: Train and Inference on the cityscapes dataset instead of the Kitti dataset.
     # You'll need a GPU with at least 10 teraFLOPS to train on.
     #  https://www.cityscapes-dataset.com/
 
-    with tf.Session() as sess:
+    cluster = None
+    if DATA_PARALLEL_REPLICAS > 1:
+        cluster = parallel.LocalCluster(DATA_PARALLEL_REPLICAS, THREADS_PER_REPLICA)
+
+    with (cluster.session() if cluster else tf.Session()) as sess:
         # Path to vgg model
         vgg_path = os.path.join(DATA_PATH, 'vgg')
 
         # Create function to get batches
-        get_batches_fn = helper.gen_batch_function(os.path.join(DATA_PATH, 'data_road/training'), image_shape)
+        training_path = os.path.join(DATA_PATH, 'data_road/training')
+        training_names, validation_names = helper.split_training_data(training_path, VALIDATION_FRACTION)
+        get_batches_fn = helper.gen_batch_function(training_path, image_shape,
+                                                   cache_dir=DATA_CACHE_PATH,
+                                                   augment=helper.BatchAugmenter() if AUGMENT else None,
+                                                   seed=AUGMENT_SEED, names=training_names,
+                                                   label_format=LABEL_FORMAT)
+        get_validation_batches_fn = helper.gen_batch_function(training_path, image_shape, cache_dir=DATA_CACHE_PATH,
+                                                              shuffle=False, names=validation_names,
+                                                              label_format=LABEL_FORMAT)
+        get_batches_fn = helper.BatchPrefetcher(get_batches_fn, num_workers=LOADER_WORKERS, prefetch=PREFETCH_BATCHES)
 
         # 1. Build NN using load_vgg, layers, and optimize function
-        input_image, keep_prob, vgg_layer3_out, vgg_layer4_out, vgg_layer7_out = load_vgg(sess, vgg_path)
-        last_layer = layers(vgg_layer3_out, vgg_layer4_out, vgg_layer7_out, NUM_CLASSES)
         learning_rate = tf.placeholder(tf.float32, name = 'learning-rate')
-
-        correct_label = tf.placeholder(tf.float32, (None, image_shape[0], image_shape[1], NUM_CLASSES),
-                                       name='correct-label')
-
-        logits, train_op, cross_entropy_loss = optimize(last_layer, correct_label, learning_rate, NUM_CLASSES)
+        if cluster:
+            replicas = parallel.build_replicas(parallel.vgg_encoder(sess, vgg_path, load_vgg), layers, cross_entropy,
+                                               cluster.devices, image_shape, NUM_CLASSES, learning_rate,
+                                               label_placeholder=partial(label_placeholder, label_format=LABEL_FORMAT))
+            input_image, correct_label, keep_prob = replicas.input_images, replicas.correct_labels, replicas.keep_prob
+            train_op, cross_entropy_loss = replicas.train_op, replicas.loss
+            # Inference runs on the first replica
+            inference_image, logits = input_image[0], replicas.last_layers[0]
+        else:
+            input_image, keep_prob, vgg_layer3_out, vgg_layer4_out, vgg_layer7_out = load_vgg(sess, vgg_path)
+            last_layer = layers(vgg_layer3_out, vgg_layer4_out, vgg_layer7_out, NUM_CLASSES)
+
+            correct_label = label_placeholder(image_shape, NUM_CLASSES, LABEL_FORMAT)
+
+            logits, train_op, cross_entropy_loss = optimize(last_layer, correct_label, learning_rate, NUM_CLASSES,
+                                                            accumulation_steps=ACCUMULATION_STEPS)
+            inference_image = input_image
 
         # 2. Train NN using the train_nn function
-        train_nn(sess, EPOCHS, BATCH_SIZE, get_batches_fn, train_op,
-                 cross_entropy_loss, input_image,
-                 correct_label, keep_prob, learning_rate)
+        train_profiler = evaluate_profiler = None
+        if PROFILE_PATH:
+            train_profiler = profiling.StepProfiler(PROFILE_PATH, PROFILE_STEPS, name='train')
+            evaluate_profiler = profiling.StepProfiler(PROFILE_PATH, PROFILE_STEPS, name='evaluate')
+
+        evaluate_fn = None
+        if validation_names:
+            engine = inference.InferenceEngine(sess, inference_image, image_shape, logits=logits,
+                                               keep_prob=keep_prob, batch_size=BATCH_SIZE,
+                                               profiler=evaluate_profiler)
+
+            def evaluate_fn():
+                if evaluate_profiler:
+                    # The time between epochs is not feed preparation
+                    evaluate_profiler.mark()
+                return metrics.evaluate(engine, get_validation_batches_fn, BATCH_SIZE)
+
+        checkpoint_manager = CheckpointManager(MODEL_SAVE_PATH, keep_last=KEEP_LAST_CHECKPOINTS,
+                                               keep_best=KEEP_BEST_CHECKPOINTS,
+                                               mode='max' if evaluate_fn else 'min', resume=RESUME_TRAINING)
+        try:
+            with get_batches_fn:
+                train_nn(sess, EPOCHS, BATCH_SIZE, get_batches_fn, train_op,
+                         cross_entropy_loss, input_image,
+                         correct_label, keep_prob, learning_rate, report_memory=REPORT_MEMORY,
+                         checkpoint_manager=checkpoint_manager, resume=RESUME_TRAINING,
+                         evaluate_fn=evaluate_fn, profiler=train_profiler)
+        finally:
+            checkpoint_manager.close()
+            for profiler in (train_profiler, evaluate_profiler):
+                if profiler:
+                    profiler.write_summary()
 
         # 3. Save inference data using helper.save_inference_samples
-        helper.save_inference_samples(RUNS_PATH, DATA_PATH, sess, image_shape, logits, keep_prob, input_image)
+        helper.save_inference_samples(RUNS_PATH, DATA_PATH, sess, image_shape, logits, keep_prob, inference_image,
+                                      output_format=SAMPLE_OUTPUT_FORMAT, tile_overlap=TILE_OVERLAP)
+
+        # OPTIONAL: Apply the trained model to a video, see video.py
+
+
+def export_model(epoch=EPOCHS - 1, export_path=FROZEN_MODEL_PATH):
+    '''Freeze the model variables of a particular epoch into a single inference-only graph'''
+    with tf.Graph().as_default(), tf.Session() as sess:
+        input_image, keep_prob, vgg_layer3_out, vgg_layer4_out, vgg_layer7_out = load_vgg(
+            sess, os.path.join(DATA_PATH, 'vgg'))
+        last_layer = layers(vgg_layer3_out, vgg_layer4_out, vgg_layer7_out, NUM_CLASSES)
+        inference.add_output_ops(last_layer)
+        load_model(sess, epoch)
+
+        graph_def = inference.freeze_graph(sess)
 
-        # OPTIONAL: Apply the trained model to a video
+    with open(export_path, 'wb') as f:
+        f.write(graph_def.SerializeToString())
+    print('Frozen model with %d ops saved in file: %s' % (len(graph_def.node), export_path))
 
 
 if __name__ == '__main__':
-    print("Starting")
-    run()
+    parser = argparse.ArgumentParser(description='Train a FCN for road segmentation on the KITTI dataset')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.add_parser('train', help='Run the self-check, train the network and save inference samples (default)')
+    subparsers.add_parser('selfcheck', help='Check the environment and run the project tests')
+    export_parser = subparsers.add_parser('export', help='Freeze a checkpoint into an inference-only graph')
+    export_parser.add_argument('--epoch', type=int, default=EPOCHS - 1, help='Epoch of the checkpoint to export')
+    export_parser.add_argument('--output', default=FROZEN_MODEL_PATH, help='Path of the frozen graph')
+    args = parser.parse_args()
+
+    if args.command == 'export':
+        export_model(args.epoch, args.output)
+    elif args.command == 'selfcheck':
+        self_check()
+    else:
+        print("Starting")
+        run()
@@ -0,0 +1,203 @@
+"""
+Compact encodings of binary road masks, for returning and storing segmentation results without full overlays.
+MaskWriter stores the masks of a run in one indexed file that MaskReader reads back by image name:
+
+    with MaskReader('runs/1500000000.0/masks.bin') as reader:
+        mask = reader.mask('um_000000.png')
+"""
+import io
+import os
+import json
+import struct
+import threading
+
+import numpy as np
+from PIL import Image
+
+
+def rle_encode(mask):
+    """
+    Run-length encode a binary mask in row-major order. The runs alternate between background and road and
+    always start with background, so a mask starting with road has a leading run of 0.
+    :param mask: bool array of any shape
+    :return: uint32 array of run lengths
+    """
+    flat = np.asarray(mask, np.bool_).ravel()
+    changes = np.flatnonzero(flat[1:] != flat[:-1]) + 1
+    counts = np.diff(np.concatenate(([0], changes, [flat.size])))
+    if flat.size and flat[0]:
+        counts = np.concatenate(([0], counts))
+    return counts.astype(np.uint32)
+
+
+def rle_decode(counts, shape):
+    """
+    :param counts: Run lengths created by rle_encode
+    :param shape: Tuple - Shape of the mask
+    :return: bool array of shape shape
+    """
+    counts = np.asarray(counts, np.intp)
+    return np.repeat(np.arange(len(counts)) % 2 == 1, counts).reshape(shape)
+
+
+def png_encode(mask):
+    """
+    :param mask: bool array of shape (H, W)
+    :return: PNG file contents of a grayscale image, 255 for road pixels and 0 elsewhere
+    """
+    output = io.BytesIO()
+    Image.fromarray(np.asarray(mask, np.uint8) * 255, 'L').save(output, format='PNG')
+    return output.getvalue()
+
+
+def png_decode(data):
+    """
+    :param data: PNG file contents created by png_encode
+    :return: bool array of shape (H, W)
+    """
+    return np.array(Image.open(io.BytesIO(data)).convert('L')) > 127
+
+
+MASK_ENCODINGS = ('rle', 'bits')
+_MAGIC = b'SEGMASK1'
+_FOOTER = struct.Struct('<Q8s')                 # Offset of the JSON index, magic
+
+
+def quantize_probability(probability):
+    """
+    :param probability: float array with values in [0, 1]
+    :return: uint8 array, 0 for 0. and 255 for 1.
+    """
+    return np.round(np.clip(probability, 0., 1.) * 255.).astype(np.uint8)
+
+
+def dequantize_probability(quantized):
+    return quantized.astype(np.float32) / 255.
+
+
+def _encode(mask, encoding):
+    if encoding == 'rle':
+        return rle_encode(mask).astype('<u4').tobytes()
+    return np.packbits(np.asarray(mask, np.bool_).ravel()).tobytes()
+
+
+def _decode(data, encoding, shape):
+    if encoding == 'rle':
+        return rle_decode(np.frombuffer(data, '<u4'), shape)
+    size = int(np.prod(shape))
+    return np.unpackbits(np.frombuffer(data, np.uint8))[:size].astype(np.bool_).reshape(shape)
+
+
+class MaskWriter(object):
+    """
+    Write the masks of a run, and optionally their road probabilities, into one container file. The records are
+    appended as they come in and a JSON index with the offset of every record is written when the writer is
+    closed, so a MaskReader can read any mask without scanning the file.
+    """
+    def __init__(self, path, encoding='rle'):
+        """
+        :param path: Path of the container file
+        :param encoding: 'rle' for run lengths, which suits masks with large regions, or 'bits' for one bit per
+                         pixel, which has a fixed size
+        """
+        assert encoding in MASK_ENCODINGS, 'Unknown mask encoding {}'.format(encoding)
+        self.path = path
+        self.encoding = encoding
+        self.entries = {}
+        self.file = open(path + '.tmp', 'wb')
+        self.file.write(_MAGIC)
+
+    def _append(self, data):
+        offset = self.file.tell()
+        self.file.write(data)
+        return [offset, len(data)]
+
+    def write(self, name, mask, probability=None):
+        """
+        :param name: Name to read the mask back by, usually the image file name
+        :param mask: bool array of shape (H, W)
+        :param probability: Optional float road probabilities of shape (H, W), stored quantized to uint8
+        """
+        entry = {'shape': list(mask.shape), 'mask': self._append(_encode(mask, self.encoding))}
+        if probability is not None:
+            entry['probability'] = self._append(quantize_probability(probability).tobytes())
+        self.entries[name] = entry
+
+    def close(self):
+        """Write the index and move the container into place"""
+        if self.file.closed:
+            return
+        index = json.dumps({'encoding': self.encoding, 'entries': self.entries}).encode()
+        index_offset = self.file.tell()
+        self.file.write(index)
+        self.file.write(_FOOTER.pack(index_offset, _MAGIC))
+        self.file.close()
+        os.replace(self.path + '.tmp', self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        if type is None:
+            self.close()
+        else:
+            self.file.close()
+            os.remove(self.path + '.tmp')
+
+
+class MaskReader(object):
+    """Random access to the masks and probabilities in a container written by MaskWriter"""
+    def __init__(self, path):
+        self.file = open(path, 'rb')
+        self.lock = threading.Lock()
+        self.file.seek(-_FOOTER.size, os.SEEK_END)
+        index_offset, magic = _FOOTER.unpack(self.file.read(_FOOTER.size))
+        if magic != _MAGIC:
+            raise ValueError('{} is not a mask container'.format(path))
+        index_size = self.file.seek(0, os.SEEK_END) - _FOOTER.size - index_offset
+        self.file.seek(index_offset)
+        index = json.loads(self.file.read(index_size).decode())
+        self.encoding = index['encoding']
+        self.entries = index['entries']
+
+    def names(self):
+        return sorted(self.entries)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, name):
+        return name in self.entries
+
+    def _read(self, offset, length):
+        with self.lock:
+            self.file.seek(offset)
+            return self.file.read(length)
+
+    def mask(self, name):
+        """
+        :param name: Name the mask was written with
+        :return: bool array of shape (H, W)
+        """
+        entry = self.entries[name]
+        return _decode(self._read(*entry['mask']), self.encoding, tuple(entry['shape']))
+
+    def probability(self, name):
+        """
+        :param name: Name the mask was written with
+        :return: float32 road probabilities of shape (H, W) with a resolution of 1/255, None if none were written
+        """
+        entry = self.entries[name]
+        if 'probability' not in entry:
+            return None
+        quantized = np.frombuffer(self._read(*entry['probability']), np.uint8).reshape(entry['shape'])
+        return dequantize_probability(quantized)
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
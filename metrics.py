@@ -0,0 +1,64 @@
+import numpy as np
+
+
+def road_mask(labels):
+    """
+    :param labels: One-hot labels of shape (N, H, W, num_classes) or class index labels of shape (N, H, W) as
+                   created by gen_batch_function
+    :return: bool array of shape (N, H, W), True for road pixels
+    """
+    if labels.ndim == 3:
+        return labels == 1
+    return labels[..., 1].astype(np.bool_)
+
+
+class ConfusionMatrix(object):
+    """
+    Road/background confusion matrix accumulated batch by batch, so the predictions never have to be kept around
+    """
+    def __init__(self):
+        self.true_positives = 0
+        self.false_positives = 0
+        self.false_negatives = 0
+        self.pixels = 0
+
+    def update(self, predictions, truth):
+        """
+        Add a batch of predictions
+        :param predictions: bool array, True for pixels predicted as road
+        :param truth: bool array of the same shape, True for road pixels
+        """
+        true_positives = np.count_nonzero(predictions & truth)
+        self.true_positives += true_positives
+        self.false_positives += np.count_nonzero(predictions) - true_positives
+        self.false_negatives += np.count_nonzero(truth) - true_positives
+        self.pixels += truth.size
+
+    def metrics(self):
+        """
+        :return: Dict with the road IoU, precision and recall and the pixel accuracy
+        """
+        true_positives = float(self.true_positives)
+        predicted = true_positives + self.false_positives
+        actual = true_positives + self.false_negatives
+        union = true_positives + self.false_positives + self.false_negatives
+        true_negatives = self.pixels - union
+        return {'iou': true_positives / union if union else 1.,
+                'precision': true_positives / predicted if predicted else 1.,
+                'recall': true_positives / actual if actual else 1.,
+                'accuracy': (true_positives + true_negatives) / self.pixels if self.pixels else 1.}
+
+
+def evaluate(engine, get_batches_fn, batch_size):
+    """
+    Road metrics of a network on a dataset, accumulated batch by batch
+    :param engine: InferenceEngine
+    :param get_batches_fn: Function to get batches of data.  Call using get_batches_fn(batch_size)
+    :param batch_size: Batch size
+    :return: Dict of metrics, see ConfusionMatrix.metrics
+    """
+    confusion_matrix = ConfusionMatrix()
+    for images, labels in get_batches_fn(batch_size):
+        _, masks = engine.predict(images)
+        confusion_matrix.update(masks, road_mask(labels))
+    return confusion_matrix.metrics()
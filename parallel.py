@@ -0,0 +1,132 @@
+"""
+Synchronous data-parallel training. Every replica runs its own copy of the encoder, layers() decoder and loss on
+a shard of the batch, sharing one set of variables. The gradients of all replicas are averaged and applied in a
+single step. Replicas are pinned to the tasks of a local in-process cluster, which gives each replica its own
+thread pools.
+"""
+import socket
+import multiprocessing
+from collections import namedtuple
+
+import tensorflow as tf
+
+Replicas = namedtuple('Replicas', ['input_images', 'correct_labels', 'keep_prob', 'last_layers', 'train_op', 'loss'])
+
+
+def _free_ports(count):
+    sockets = [socket.socket() for _ in range(count)]
+    try:
+        for s in sockets:
+            s.bind(('localhost', 0))
+        return [s.getsockname()[1] for s in sockets]
+    finally:
+        for s in sockets:
+            s.close()
+
+
+class LocalCluster(object):
+    """One in-process tf.train.Server per replica, each with explicitly sized thread pools"""
+    def __init__(self, num_replicas, threads_per_replica=None):
+        """
+        :param num_replicas: Number of replicas
+        :param threads_per_replica: Intra-op threads per replica, the CPU cores are split evenly by default
+        """
+        threads = threads_per_replica or max(1, multiprocessing.cpu_count() // num_replicas)
+        self.config = tf.ConfigProto(intra_op_parallelism_threads=threads, inter_op_parallelism_threads=2,
+                                     allow_soft_placement=True)
+        cluster = tf.train.ClusterSpec({'worker': ['localhost:%d' % port for port in _free_ports(num_replicas)]})
+        self.servers = [tf.train.Server(cluster, job_name='worker', task_index=i, config=self.config)
+                        for i in range(num_replicas)]
+        self.devices = ['/job:worker/task:%d' % i for i in range(num_replicas)]
+
+    def session(self):
+        return tf.Session(self.servers[0].target, config=self.config)
+
+
+def vgg_encoder(sess, vgg_path, load_vgg):
+    """
+    Encoder function for build_replicas that replicates the pretrained VGG. The first replica loads the model,
+    the others import its inference graph with their own input, reading the variables of the first replica.
+    :param sess: TF Session
+    :param vgg_path: Path to vgg folder, containing "variables/" and "saved_model.pb"
+    :param load_vgg: Function loading the VGG model, see main.load_vgg
+    :return: Function of the replica index returning (image_input, keep_prob, layer3_out, layer4_out, layer7_out)
+    """
+    first = {}
+
+    def encoder(replica):
+        if replica == 0:
+            first['outputs'] = load_vgg(sess, vgg_path)
+            first['graph_def'] = tf.graph_util.extract_sub_graph(
+                sess.graph.as_graph_def(), ['layer3_out', 'layer4_out', 'layer7_out'])
+            first['variables'] = {var.op.name: var for var in tf.global_variables()}
+            return first['outputs']
+
+        image_input, keep_prob = first['outputs'][:2]
+        replica_input = tf.placeholder(image_input.dtype, image_input.get_shape(), name='image_input_%d' % replica)
+        input_map = {'image_input:0': replica_input, 'keep_prob:0': keep_prob}
+        for node in first['graph_def'].node:
+            if node.name in first['variables']:
+                input_map[node.name + ':0'] = first['variables'][node.name].value()
+        layer3_out, layer4_out, layer7_out = tf.import_graph_def(
+            first['graph_def'], input_map=input_map, name='replica_%d' % replica,
+            return_elements=['layer3_out:0', 'layer4_out:0', 'layer7_out:0'])
+        return replica_input, keep_prob, layer3_out, layer4_out, layer7_out
+
+    return encoder
+
+
+def average_gradients(replica_gradients):
+    """
+    :param replica_gradients: List with the (gradient, variable) list of every replica
+    :return: List of (averaged gradient, variable)
+    """
+    averaged = []
+    for grads_and_vars in zip(*replica_gradients):
+        grads = [grad for grad, _ in grads_and_vars if grad is not None]
+        if grads:
+            averaged.append((tf.add_n(grads) / len(grads), grads_and_vars[0][1]))
+    return averaged
+
+
+def build_replicas(encoder, layers, cross_entropy, devices, image_shape, num_classes, learning_rate,
+                   label_placeholder=None):
+    """
+    Build one replica of the network per device and a train op applying the averaged gradients
+    :param encoder: Function of the replica index returning (image_input, keep_prob, layer3, layer4, layer7)
+    :param layers: Function building the decoder, see main.layers
+    :param cross_entropy: Function building the loss, see main.cross_entropy
+    :param devices: Device of every replica
+    :param image_shape: Tuple - Shape of image
+    :param num_classes: Number of classes to classify
+    :param learning_rate: TF Placeholder for the learning rate
+    :param label_placeholder: Optional function of (image_shape, num_classes, name) creating the label placeholder
+                              of a replica, see main.label_placeholder. Float32 one-hot labels by default.
+    :return: Replicas
+    """
+    optimizer = tf.train.AdamOptimizer(learning_rate)
+    input_images, correct_labels, last_layers, losses, replica_gradients = [], [], [], [], []
+    keep_prob = None
+    for replica, device in enumerate(devices):
+        # The first replica creates the decoder variables under their usual names, the others reuse them
+        with tf.device(device), tf.variable_scope(tf.get_variable_scope(), reuse=replica > 0):
+            image_input, keep_prob, layer3_out, layer4_out, layer7_out = encoder(replica)
+            last_layer = layers(layer3_out, layer4_out, layer7_out, num_classes)
+            if label_placeholder:
+                correct_label = label_placeholder(image_shape, num_classes, name='correct-label-%d' % replica)
+            else:
+                correct_label = tf.placeholder(tf.float32, (None, image_shape[0], image_shape[1], num_classes),
+                                               name='correct-label-%d' % replica)
+            _, loss = cross_entropy(last_layer, correct_label, num_classes)
+            replica_gradients.append(optimizer.compute_gradients(loss))
+
+        input_images.append(image_input)
+        correct_labels.append(correct_label)
+        last_layers.append(last_layer)
+        losses.append(loss)
+
+    with tf.device(devices[0]):
+        train_op = optimizer.apply_gradients(average_gradients(replica_gradients))
+        loss = tf.reduce_mean(losses)
+
+    return Replicas(input_images, correct_labels, keep_prob, last_layers, train_op, loss)
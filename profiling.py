@@ -0,0 +1,128 @@
+"""
+Opt-in profiling of training and inference steps. A StepProfiler wraps sess.run: it times every step, split into
+the feed preparation before sess.run and sess.run itself, and runs selected steps with a full trace. The trace of
+each of those steps is written as a Chrome trace (open it at chrome://tracing), and the ops of the FCN decoder
+are summed over all traced steps to find the most expensive ones.
+
+Code that takes a profiler uses sess.run directly when it is None, so profiling costs nothing when disabled.
+"""
+import os
+import json
+import time
+from collections import defaultdict
+
+import numpy as np
+import tensorflow as tf
+
+# Name fragments of the decoder ops created by main.layer_1x1_conv, main.layer_transposed and
+# main.layer_skip_connection, their gradients included
+DECODER_OPS = ('_1x1_conv', '_transposed_conv', '_skip_connection')
+
+
+class StepProfiler(object):
+    """Time the steps run through it and trace selected ones"""
+    def __init__(self, output_dir, trace_steps=(10,), top_n=10, op_patterns=DECODER_OPS, name='train'):
+        """
+        :param output_dir: Directory to write the Chrome traces and the summary to
+        :param trace_steps: Steps, counted from 0, to run with a full trace. The first steps are usually slower.
+        :param top_n: Number of most expensive ops in the summary
+        :param op_patterns: Name fragments of the ops to summarize, None summarizes all ops
+        :param name: Prefix of the files written, to tell profilers apart
+        """
+        self.output_dir = output_dir
+        self.trace_steps = set(trace_steps)
+        self.top_n = top_n
+        self.op_patterns = op_patterns
+        self.name = name
+        self.step = 0
+        self.feed_times = []
+        self.run_times = []
+        self.op_micros = defaultdict(int)
+        self.traced = []
+        self._last_end = None
+        os.makedirs(output_dir, exist_ok=True)
+
+    def mark(self):
+        """Start timing the feed preparation of the next step from now, e.g. at the start of an epoch"""
+        self._last_end = time.time()
+
+    def wrap(self, sess):
+        """
+        :param sess: TF Session
+        :return: Function with the signature of sess.run that profiles every call
+        """
+        def run(fetches, feed_dict=None):
+            return self.run(sess, fetches, feed_dict)
+        return run
+
+    def run(self, sess, fetches, feed_dict=None):
+        """
+        sess.run with timing, and with a full trace if this step is one of trace_steps
+        :return: Result of sess.run
+        """
+        start = time.time()
+        self.feed_times.append(start - self._last_end if self._last_end is not None else 0.)
+
+        if self.step in self.trace_steps:
+            run_metadata = tf.RunMetadata()
+            result = sess.run(fetches, feed_dict, options=tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE),
+                              run_metadata=run_metadata)
+            self.run_times.append(time.time() - start)
+            self._record_trace(run_metadata)
+        else:
+            result = sess.run(fetches, feed_dict)
+            self.run_times.append(time.time() - start)
+
+        self.step += 1
+        self._last_end = time.time()
+        return result
+
+    def _record_trace(self, run_metadata):
+        from tensorflow.python.client import timeline
+
+        path = os.path.join(self.output_dir, '{}_step{}.trace.json'.format(self.name, self.step))
+        with open(path, 'w') as f:
+            f.write(timeline.Timeline(run_metadata.step_stats).generate_chrome_trace_format())
+        self.traced.append(self.step)
+
+        for device_stats in run_metadata.step_stats.dev_stats:
+            for node_stats in device_stats.node_stats:
+                name = node_stats.node_name.split(':')[0]
+                if self.op_patterns is None or any(pattern in name for pattern in self.op_patterns):
+                    self.op_micros[name] += node_stats.all_end_rel_micros
+
+    def summary(self):
+        """
+        :return: Dict with the number of steps, the mean and p50 feed, sess.run and step time in ms, the traced
+                 steps and the top_n most expensive summarized ops with their mean time per traced step in ms
+        """
+        summary = {'steps': self.step, 'traced_steps': self.traced}
+        if self.step:
+            feed_ms = 1000. * np.array(self.feed_times)
+            run_ms = 1000. * np.array(self.run_times)
+            for name, times in (('feed', feed_ms), ('run', run_ms), ('step', feed_ms + run_ms)):
+                summary[name + '_mean_ms'] = float(times.mean())
+                summary[name + '_p50_ms'] = float(np.percentile(times, 50))
+
+        total = float(sum(self.op_micros.values())) or 1.
+        top = sorted(self.op_micros.items(), key=lambda item: item[1], reverse=True)[:self.top_n]
+        summary['top_ops'] = [{'op': name, 'ms_per_step': micros / 1000. / max(len(self.traced), 1),
+                               'share': micros / total} for name, micros in top]
+        return summary
+
+    def write_summary(self):
+        """
+        Print the summary and write it to output_dir
+        :return: Path of the summary file
+        """
+        summary = self.summary()
+        if self.step:
+            print('Profile {}: {} steps, feed {:.1f} ms, sess.run {:.1f} ms per step (mean)'.format(
+                self.name, summary['steps'], summary['feed_mean_ms'], summary['run_mean_ms']))
+        for op in summary['top_ops']:
+            print('  {ms_per_step:8.2f} ms {share:6.1%}  {op}'.format(**op))
+
+        path = os.path.join(self.output_dir, '{}_summary.json'.format(self.name))
+        with open(path, 'w') as f:
+            json.dump(summary, f, indent=2)
+        return path
@@ -110,6 +110,24 @@ def test_optimize(optimize):
     assert test.min() != 0 or test.max() != 0, 'Training operation not changing weights.'
 
 
+@test_safe
+def test_sparse_cross_entropy(cross_entropy, one_hot):
+    num_classes = 2
+    shape = [2, 3, 4]
+    layers_output = tf.constant(np.random.RandomState(0).randn(*shape, num_classes), tf.float32)
+    labels = np.random.RandomState(1).randint(0, num_classes, shape).astype(np.uint8)
+    dense_label = tf.placeholder(tf.float32, [None, None, None, num_classes])
+    sparse_label = tf.placeholder(tf.uint8, [None, None, None])
+    _, dense_loss = cross_entropy(layers_output, dense_label, num_classes)
+    _, sparse_loss = cross_entropy(layers_output, sparse_label, num_classes)
+
+    with tf.Session() as sess:
+        dense, sparse = sess.run([dense_loss, sparse_loss], {dense_label: one_hot(labels, num_classes),
+                                                             sparse_label: labels})
+
+    assert np.isclose(dense, sparse), 'Sparse loss {} differs from the one-hot loss {}'.format(sparse, dense)
+
+
 @test_safe
 def test_train_nn(train_nn):
     epochs = 1
@@ -152,3 +170,747 @@ def test_for_kitti_dataset(data_dir):
     assert training_images_count == 289, 'Expected 289 training images, found {} images.'.format(training_images_count)
     assert training_labels_count == 289, 'Expected 289 training labels, found {} labels.'.format(training_labels_count)
     assert testing_images_count == 290, 'Expected 290 testing images, found {} images.'.format(testing_images_count)
+
+
+@test_safe
+def test_segment_stream(segment_stream, synthetic_frames, inference_engine):
+    image_shape = (16, 32)
+    frame_count = 10
+    image_input = tf.placeholder(tf.float32, (None, image_shape[0], image_shape[1], 3))
+    road = tf.reduce_mean(image_input, axis=3, keep_dims=True) - 127.5
+    logits = tf.concat([-road, road], axis=3)
+
+    frames = []
+    with tf.Session() as sess:
+        engine = inference_engine(sess, image_input, image_shape, logits=logits, batch_size=3)
+        stats = segment_stream(engine, synthetic_frames(frame_count, (20, 40)), frames.append)
+
+    assert stats['frames'] == frame_count, 'Expected {} frames, found {}.'.format(frame_count, stats['frames'])
+    assert len(frames) == frame_count, 'Expected {} frames written, found {}.'.format(frame_count, len(frames))
+    assert all(frame.shape == image_shape + (3,) for frame in frames), 'Output frames have the wrong shape.'
+    assert stats['fps'] > 0, 'FPS not reported.'
+
+
+@test_safe
+def test_serve(segmentation_server, dynamic_batcher, inference_engine, rle_decode, png_decode):
+    import io
+    import json
+    import threading
+    from urllib.request import urlopen
+    from PIL import Image
+
+    image_shape = (16, 32)
+    request_count = 8
+    image_input = tf.placeholder(tf.float32, (None, image_shape[0], image_shape[1], 3))
+    road = tf.reduce_mean(image_input, axis=3, keep_dims=True) - 127.5
+    logits = tf.concat([-road, road], axis=3)
+    rng = np.random.RandomState(0)
+    images = [rng.randint(0, 256, size=image_shape + (3,)).astype(np.uint8) for _ in range(request_count)]
+
+    with tf.Session() as sess:
+        engine = inference_engine(sess, image_input, image_shape, logits=logits, batch_size=4)
+        batcher = dynamic_batcher(engine, max_latency=1.)
+        with segmentation_server(batcher, quiet=True).start() as server:
+            masks = [None] * request_count
+
+            def request(i):
+                body = io.BytesIO()
+                Image.fromarray(images[i]).save(body, format='PNG')
+                output_format = 'rle' if i % 2 else 'png'
+                url = '{}/segment?format={}'.format(server.url, output_format)
+                with urlopen(url, data=body.getvalue(), timeout=30) as response:
+                    if output_format == 'rle':
+                        result = json.loads(response.read().decode())
+                        masks[i] = rle_decode(result['counts'], result['shape'])
+                    else:
+                        masks[i] = png_decode(response.read())
+
+            threads = [threading.Thread(target=request, args=(i,)) for i in range(request_count)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            with urlopen(server.url + '/stats', timeout=30) as response:
+                stats = json.loads(response.read().decode())
+
+    for image, mask in zip(images, masks):
+        assert mask is not None, 'Request failed.'
+        assert np.array_equal(mask, image.mean(axis=2) > 127.5), 'Served mask differs from the expected mask.'
+    histogram = {int(size): count for size, count in stats['batch_size_histogram'].items()}
+    assert stats['requests'] == request_count, \
+        'Expected {} requests, found {}.'.format(request_count, stats['requests'])
+    assert sum(size * count for size, count in histogram.items()) == request_count, 'Batch size histogram is wrong.'
+    assert max(histogram) > 1, 'Concurrent requests were not batched.'
+    assert max(histogram) <= 4, 'Batch larger than the maximum batch size.'
+    assert stats['latency_p50_ms'] <= stats['latency_p99_ms'], 'Latency percentiles are wrong.'
+
+
+@test_safe
+def test_mask_container(mask_writer, mask_reader, encodings):
+    import shutil
+    import tempfile
+
+    rng = np.random.RandomState(0)
+    masks = {'um_%06d.png' % i: rng.rand(16, 32) < 0.3 for i in range(5)}
+    probabilities = {name: rng.rand(16, 32) for name in masks}
+    work_dir = tempfile.mkdtemp()
+    try:
+        _check_mask_containers(mask_writer, mask_reader, encodings, work_dir, masks, probabilities)
+    finally:
+        shutil.rmtree(work_dir)
+
+
+def _check_mask_containers(mask_writer, mask_reader, encodings, work_dir, masks, probabilities):
+    for encoding in encodings:
+        path = os.path.join(work_dir, encoding + '.bin')
+        with mask_writer(path, encoding) as writer:
+            for i, name in enumerate(sorted(masks)):
+                writer.write(name, masks[name], probabilities[name] if i % 2 else None)
+
+        with mask_reader(path) as reader:
+            assert reader.names() == sorted(masks), 'Wrong names in the {} container.'.format(encoding)
+            for i, name in reversed(list(enumerate(sorted(masks)))):
+                assert np.array_equal(reader.mask(name), masks[name]), 'Wrong {} mask {}.'.format(encoding, name)
+                probability = reader.probability(name)
+                if i % 2:
+                    assert np.abs(probability - probabilities[name]).max() <= 0.5 / 255 + 1e-6, \
+                        'Probabilities of {} not restored to uint8 precision.'.format(name)
+                else:
+                    assert probability is None, 'Probabilities of {} were not written.'.format(name)
+
+
+@test_safe
+def test_vgg_provisioning(maybe_download_pretrained_vgg):
+    import shutil
+    import tempfile
+    import zipfile
+
+    work_dir = tempfile.mkdtemp()
+    try:
+        mirror = os.path.join(work_dir, 'mirror')
+        os.makedirs(mirror)
+        files = ['variables/variables.data-00000-of-00001', 'variables/variables.index', 'saved_model.pb']
+        with zipfile.ZipFile(os.path.join(mirror, 'vgg.zip'), 'w') as zip_file:
+            for name in files:
+                zip_file.writestr('vgg/' + name, name * 100)
+
+        cache_dir = os.path.join(work_dir, 'cache')
+        for data_dir in (os.path.join(work_dir, 'data'), os.path.join(work_dir, 'data2')):
+            os.makedirs(data_dir)
+            _prevent_print(maybe_download_pretrained_vgg, {'data_dir': data_dir, 'cache_dir': cache_dir,
+                                                           'mirror': 'file://' + mirror})
+            for name in files:
+                with open(os.path.join(data_dir, 'vgg', name)) as f:
+                    assert f.read() == name * 100, 'Wrong content of {}.'.format(name)
+
+        assert len(os.listdir(os.path.join(cache_dir, 'sha256'))) == 1, 'The second data dir did not use the cache.'
+
+        # A complete model directory that is not a link into the cache is kept
+        data_dir = os.path.join(work_dir, 'data3')
+        shutil.copytree(os.path.join(work_dir, 'data', 'vgg'), os.path.join(data_dir, 'vgg'))
+        _prevent_print(maybe_download_pretrained_vgg, {'data_dir': data_dir, 'cache_dir': cache_dir,
+                                                       'mirror': 'file://' + mirror})
+        assert not os.path.islink(os.path.join(data_dir, 'vgg')), 'An existing model directory was replaced.'
+        assert all(os.path.exists(os.path.join(data_dir, 'vgg', name)) for name in files), \
+            'An existing model directory was changed.'
+
+        # A truncated model directory is replaced, also when an interrupted run left a temporary link behind
+        data_dir = os.path.join(work_dir, 'data4')
+        shutil.copytree(os.path.join(work_dir, 'data', 'vgg'), os.path.join(data_dir, 'vgg'))
+        with open(os.path.join(data_dir, 'vgg', 'saved_model.pb'), 'w') as f:
+            f.write('saved_model.pb')
+        os.makedirs(os.path.join(data_dir, 'vgg.tmp'))
+        _prevent_print(maybe_download_pretrained_vgg, {'data_dir': data_dir, 'cache_dir': cache_dir,
+                                                       'mirror': 'file://' + mirror})
+        with open(os.path.join(data_dir, 'vgg', 'saved_model.pb')) as f:
+            assert f.read() == 'saved_model.pb' * 100, 'A truncated model directory was kept.'
+        assert not os.path.exists(os.path.join(data_dir, 'vgg.tmp')), 'Temporary link left behind.'
+        assert len(os.listdir(os.path.join(cache_dir, 'sha256'))) == 1, 'The model was cached twice.'
+    finally:
+        shutil.rmtree(work_dir)
+
+
+@test_safe
+def test_step_profiler(step_profiler, inference_engine):
+    import json
+    import shutil
+    import tempfile
+
+    image_shape = (16, 32)
+    image_input = tf.placeholder(tf.float32, (None, image_shape[0], image_shape[1], 3))
+    logits = tf.layers.conv2d(image_input, 2, 1, name='toy_1x1_conv')
+    output_dir = tempfile.mkdtemp()
+    try:
+        profiler = step_profiler(output_dir, trace_steps=(1,), name='test')
+        with tf.Session() as sess:
+            sess.run(tf.global_variables_initializer())
+            engine = inference_engine(sess, image_input, image_shape, logits=logits, profiler=profiler)
+            for _ in range(3):
+                engine.predict(np.zeros((2,) + image_shape + (3,), np.uint8))
+        _prevent_print(profiler.write_summary, {})
+
+        assert os.path.exists(os.path.join(output_dir, 'test_step1.trace.json')), 'Chrome trace not written.'
+        with open(os.path.join(output_dir, 'test_summary.json')) as f:
+            summary = json.load(f)
+    finally:
+        shutil.rmtree(output_dir)
+
+    assert summary['steps'] == 3, 'Expected 3 steps, found {}.'.format(summary['steps'])
+    assert summary['traced_steps'] == [1], 'Expected step 1 to be traced, found {}.'.format(summary['traced_steps'])
+    assert any('toy_1x1_conv' in op['op'] for op in summary['top_ops']), 'Decoder op missing from the summary.'
+
+
+@test_safe
+def test_checkpoint_manager(checkpoint_manager):
+    import shutil
+    import tempfile
+
+    checkpoint_dir = tempfile.mkdtemp()
+    try:
+        variable = tf.Variable(0., name='weight')
+        assign = tf.placeholder(tf.float32)
+        assign_op = variable.assign(assign)
+        metrics = [0.5, 0.9, 0.6, 0.7, 0.8]
+
+        with tf.Session() as sess:
+            manager = checkpoint_manager(checkpoint_dir, keep_last=2, keep_best=1, mode='max')
+            for epoch, metric in enumerate(metrics):
+                sess.run(assign_op, {assign: float(epoch)})
+                manager.save(sess, epoch, metric)
+            manager.close()
+            assert [entry['epoch'] for entry in manager.index] == [1, 3, 4], \
+                'Expected the last 2 and the best checkpoint, found epochs {}.'.format(manager.index)
+            assert not glob(os.path.join(checkpoint_dir, 'P2-epoch0.ckpt.*')), 'Checkpoint of epoch 0 not removed.'
+            assert manager.best()['epoch'] == 1, 'Wrong best checkpoint.'
+
+            manager = checkpoint_manager(checkpoint_dir, resume=True)
+            sess.run(assign_op, {assign: -1.})
+            next_epoch = manager.restore_latest(sess)
+            assert next_epoch == len(metrics), 'Expected to resume at epoch {}, found {}.'.format(len(metrics),
+                                                                                                   next_epoch)
+            assert sess.run(variable) == len(metrics) - 1, 'Latest checkpoint not restored.'
+            manager.close()
+
+            # A new run ignores the index of the earlier one and keeps its own first checkpoint
+            manager = checkpoint_manager(checkpoint_dir, keep_last=2, keep_best=1, mode='max')
+            assert manager.restore_latest(sess) == 0, 'A new run restored a checkpoint of an earlier run.'
+            manager.save(sess, 0, 0.1)
+            manager.close()
+            assert [entry['epoch'] for entry in manager.index] == [0], \
+                'Retention of a new run counted earlier checkpoints: {}.'.format(manager.index)
+            assert glob(os.path.join(checkpoint_dir, 'P2-epoch0.ckpt.*')), 'Checkpoint of the new run removed.'
+    finally:
+        shutil.rmtree(checkpoint_dir)
+
+
+@test_safe
+def test_accumulate_gradients(accumulate_gradients):
+    steps = 4
+    micro_batch = 5
+    rng = np.random.RandomState(0)
+    inputs = rng.randn(steps * micro_batch, 3).astype(np.float32)
+    targets = rng.randn(steps * micro_batch, 1).astype(np.float32)
+    initial = rng.randn(3, 1).astype(np.float32)
+    x = tf.placeholder(tf.float32, (None, 3))
+    y = tf.placeholder(tf.float32, (None, 1))
+
+    def model(name):
+        weight = tf.Variable(initial, name=name)
+        return weight, tf.reduce_mean(tf.square(tf.matmul(x, weight) - y))
+
+    # One step on the whole batch against the mean gradient of the micro-batches
+    large_weight, large_loss = model('large')
+    large_op = tf.train.GradientDescentOptimizer(0.1).minimize(large_loss, var_list=[large_weight])
+    micro_weight, micro_loss = model('micro')
+    micro = accumulate_gradients(tf.train.GradientDescentOptimizer(0.1), micro_loss, steps)
+    adam_weight, adam_loss = model('adam')
+    adam = accumulate_gradients(tf.train.AdamOptimizer(0.1), adam_loss, steps)
+
+    with tf.Session() as sess:
+        sess.run(tf.global_variables_initializer())
+        sess.run(tf.local_variables_initializer())
+        for _ in range(2):
+            sess.run(large_op, {x: inputs, y: targets})
+            for batch_i in range(0, len(inputs), micro_batch):
+                feed_dict = {x: inputs[batch_i:batch_i+micro_batch], y: targets[batch_i:batch_i+micro_batch]}
+                sess.run(micro.accumulate_op, feed_dict)
+            sess.run(micro.apply_op)
+
+        large, accumulated = sess.run([large_weight, micro_weight])
+        assert np.allclose(large, accumulated, atol=1e-5), 'Accumulated update differs from the large batch update.'
+
+        # An update where no micro-batch has finite gradients is skipped entirely
+        overflow = np.full_like(inputs[:micro_batch], np.inf)
+        for _ in range(steps):
+            sess.run(adam.accumulate_op, {x: overflow, y: targets[:micro_batch]})
+        sess.run(adam.apply_op)
+        assert np.array_equal(sess.run(adam_weight), initial), 'Weights changed by an update of non-finite batches.'
+
+
+
+@test_safe
+def test_data_parallel(local_cluster, vgg_encoder, build_replicas, layers, cross_entropy):
+    image_shape = (32, 64)
+    num_classes = 2
+    rng = np.random.RandomState(0)
+    images = rng.rand(4, image_shape[0], image_shape[1], 3).astype(np.float32)
+    labels = np.eye(num_classes, dtype=np.float32)[rng.randint(0, num_classes, size=(4,) + image_shape)]
+    # Encoder with the tensor names and the 1/8, 1/16 and 1/32 resolution outputs of the pretrained VGG
+    encoder_weights = [('toy_layer3', 8, 0.1 * rng.randn(8, 8, 3, 8)), ('toy_layer4', 2, 0.1 * rng.randn(2, 2, 8, 8)),
+                       ('toy_layer7', 2, 0.1 * rng.randn(2, 2, 8, 16))]
+
+    def load_toy_vgg(sess, vgg_path):
+        image_input = tf.placeholder(tf.float32, (None, image_shape[0], image_shape[1], 3), name='image_input')
+        keep_prob = tf.placeholder(tf.float32, name='keep_prob')
+        layer = tf.nn.dropout(image_input, keep_prob)
+        outputs = []
+        for name, stride, weight in encoder_weights:
+            weight = tf.Variable(weight.astype(np.float32), name=name)
+            layer = tf.nn.relu(tf.nn.conv2d(layer, weight, [1, stride, stride, 1], 'SAME'))
+            outputs.append(tf.identity(layer, name=name.replace('toy_', '') + '_out'))
+        return [image_input, keep_prob] + outputs
+
+    feed_dict = {}
+    with tf.Graph().as_default():
+        cluster = local_cluster(2, threads_per_replica=1)
+        learning_rate = tf.placeholder(tf.float32)
+        with cluster.session() as sess:
+            replicas = build_replicas(vgg_encoder(sess, None, load_toy_vgg), layers, cross_entropy, cluster.devices,
+                                      image_shape, num_classes, learning_rate)
+            sess.run(tf.global_variables_initializer())
+
+            # Replica 1 computes the same output as replica 0 and follows changes to the variables of replica 0
+            same_input = {replicas.input_images[0]: images, replicas.input_images[1]: images, replicas.keep_prob: 1.}
+            first, second = sess.run(replicas.last_layers, same_input)
+            assert np.allclose(first, second, atol=1e-5), 'Replica 1 differs from replica 0.'
+            layer7 = [var for var in tf.global_variables() if var.op.name == 'toy_layer7'][0]
+            layer7.load(np.zeros(layer7.get_shape().as_list(), np.float32), sess)
+            changed_first, changed_second = sess.run(replicas.last_layers, same_input)
+            assert not np.allclose(first, changed_first), 'Changing a replica 0 variable had no effect.'
+            assert np.allclose(changed_first, changed_second, atol=1e-5), \
+                'Replica 1 does not read the variables of replica 0.'
+            sess.run(tf.global_variables_initializer())
+
+            initial = {var.op.name: sess.run(var) for var in tf.trainable_variables()}
+            feed_dict = {learning_rate: 0.001, replicas.keep_prob: 1.}
+            feed_dict.update(zip(replicas.input_images, np.array_split(images, 2)))
+            feed_dict.update(zip(replicas.correct_labels, np.array_split(labels, 2)))
+            sess.run(replicas.train_op, feed_dict)
+            averaged = {var.op.name: sess.run(var) for var in tf.trainable_variables()}
+
+    # One step of a single session on the whole batch
+    with tf.Graph().as_default(), tf.Session() as sess:
+        image_input, keep_prob, layer3_out, layer4_out, layer7_out = load_toy_vgg(sess, None)
+        last_layer = layers(layer3_out, layer4_out, layer7_out, num_classes)
+        correct_label = tf.placeholder(tf.float32, (None, image_shape[0], image_shape[1], num_classes))
+        learning_rate = tf.placeholder(tf.float32)
+        _, loss = cross_entropy(last_layer, correct_label, num_classes)
+        train_op = tf.train.AdamOptimizer(learning_rate).minimize(loss)
+        sess.run(tf.global_variables_initializer())
+
+        variables = tf.trainable_variables()
+        assert sorted(var.op.name for var in variables) == sorted(initial), \
+            'The replicas do not share one set of variables, found {}.'.format(sorted(initial))
+        for var in variables:
+            var.load(initial[var.op.name], sess)
+        sess.run(train_op, {image_input: images, correct_label: labels, keep_prob: 1., learning_rate: 0.001})
+        for var in variables:
+            assert np.allclose(sess.run(var), averaged[var.op.name], atol=1e-5), \
+                'Averaged update of {} differs from the whole batch update.'.format(var.op.name)
+
+@test_safe
+def test_tiled_inference(tiled_inference, tile_offsets, inference_engine):
+    tile_shape = (16, 32)
+    for length, tile, overlap in ((50, 16, 4), (100, 32, 8), (16, 16, 4), (10, 16, 4)):
+        offsets = tile_offsets(length, tile, overlap)
+        covered = np.zeros(max(length, tile), np.bool_)
+        for offset in offsets:
+            covered[offset:offset+tile] = True
+        assert covered[:length].all(), 'Tiles {} do not cover length {}.'.format(offsets, length)
+        assert all(b - a <= tile - overlap for a, b in zip(offsets, offsets[1:])), \
+            'Tiles {} overlap by less than {}.'.format(offsets, overlap)
+
+    # Logits that only depend on the pixel itself come out of the blending unchanged, at any image size
+    image_input = tf.placeholder(tf.float32, (None, tile_shape[0], tile_shape[1], 3))
+    road = image_input[..., :1] / 64. - 2.
+    logits = tf.concat([tf.zeros_like(road), road], axis=3)
+    rng = np.random.RandomState(0)
+    images = [rng.randint(0, 256, size=shape + (3,)).astype(np.uint8) for shape in ((40, 100), (12, 20))]
+
+    with tf.Session() as sess:
+        engine = inference_engine(sess, image_input, tile_shape, logits=logits)
+        tiled = tiled_inference(engine, overlap=(4, 8))
+        probabilities, masks = tiled.predict(images)
+
+    for image, probability, mask in zip(images, probabilities, masks):
+        expected = 1. / (1. + np.exp(-(image[..., 0] / 64. - 2.)))
+        assert probability.shape == image.shape[:2], 'Tiled output has the wrong shape.'
+        assert np.allclose(probability, expected, atol=1e-5), 'Blended tiles differ from the per-pixel result.'
+        assert np.array_equal(mask, probability > 0.5), 'Mask does not match the probabilities.'
+
+
+@test_safe
+def test_freeze_graph(freeze_graph, add_output_ops, engine_from_graph_def):
+    image_shape = (16, 32)
+    image_input = tf.placeholder(tf.float32, (None, image_shape[0], image_shape[1], 3), name='image_input')
+    keep_prob = tf.placeholder(tf.float32, name='keep_prob')
+    hidden = tf.nn.dropout(tf.layers.conv2d(image_input, 4, 1, name='toy_conv'), keep_prob)
+    add_output_ops(tf.layers.conv2d(hidden, 2, 1, name='toy_1x1_conv'))
+
+    images = np.random.RandomState(0).randint(0, 256, size=(2,) + image_shape + (3,)).astype(np.uint8)
+    with tf.Session() as sess:
+        sess.run(tf.global_variables_initializer())
+        expected = sess.run('road_probability:0', {image_input: images, keep_prob: 1.})
+        graph_def = freeze_graph(sess)
+
+    node_names = [node.name for node in graph_def.node]
+    assert 'keep_prob' not in node_names, 'The frozen graph still has the keep_prob placeholder.'
+    assert not [name for name in node_names if 'dropout' in name], 'The frozen graph still has dropout ops.'
+    assert [node.name for node in graph_def.node if node.op == 'Placeholder'] == ['image_input'], \
+        'The frozen graph has other inputs than image_input.'
+
+    engine = engine_from_graph_def(graph_def, image_shape)
+    probabilities, _ = engine.predict(images)
+    engine.sess.close()
+    assert np.allclose(probabilities, expected, atol=1e-5), 'The frozen graph predicts differently.'
+
+
+
+@test_safe
+def test_quantize(convert, freeze_graph, add_output_ops, engine_from_graph_def):
+    from tensorflow.core.framework import types_pb2
+
+    image_shape = (16, 32)
+    images = np.random.RandomState(0).randint(0, 256, size=(4,) + image_shape + (3,)).astype(np.uint8)
+    with tf.Graph().as_default():
+        image_input = tf.placeholder(tf.float32, (None, image_shape[0], image_shape[1], 3), name='image_input')
+        keep_prob = tf.placeholder(tf.float32, name='keep_prob')
+        hidden = tf.nn.dropout(tf.layers.conv2d(image_input / 255., 8, 3, padding='same', activation=tf.nn.relu,
+                                                name='toy_conv'), keep_prob)
+        add_output_ops(tf.layers.conv2d(hidden, 2, 1, name='toy_1x1_conv'))
+        with tf.Session() as sess:
+            sess.run(tf.global_variables_initializer())
+            graph_def = freeze_graph(sess)
+
+    def predict(mode_graph_def):
+        engine = engine_from_graph_def(mode_graph_def, image_shape)
+        try:
+            return engine.predict(images)
+        finally:
+            engine.sess.close()
+
+    assert convert(graph_def, 'float32', None, image_shape) is graph_def, 'float32 must return the model as is.'
+    probabilities, masks = predict(graph_def)
+    for mode, atol in (('float16', 0.01), ('int8_weights', 0.05)):
+        converted = convert(graph_def, mode, None, image_shape)
+        if mode == 'float16':
+            assert not [node.name for node in converted.node
+                        if node.op == 'Const' and node.attr['value'].tensor.dtype == types_pb2.DT_FLOAT], \
+                'float16 left float32 weights in the model.'
+        else:
+            assert converted.ByteSize() < graph_def.ByteSize(), 'int8_weights did not shrink the model.'
+        mode_probabilities, mode_masks = predict(converted)
+        assert np.allclose(mode_probabilities.astype(np.float32), probabilities, atol=atol), \
+            '{} probabilities differ from float32 by up to {}.'.format(
+                mode, np.abs(mode_probabilities.astype(np.float32) - probabilities).max())
+        assert np.mean(mode_masks == masks) > 0.95, '{} masks differ from float32.'.format(mode)
+
+@test_safe
+def test_preprocess_dataset(preprocess_dataset, gen_batch_function, write_synthetic_kitti):
+    import shutil
+    import tempfile
+    from PIL import Image
+
+    image_shape = (16, 32)
+    frame_shape = (30, 60)
+    work_dir = tempfile.mkdtemp()
+    try:
+        data_folder = os.path.join(work_dir, 'training')
+        cache_dir = os.path.join(work_dir, 'cache')
+        write_synthetic_kitti(data_folder, 5, frame_shape)
+
+        def check_batches():
+            for label_format in ('dense', 'sparse'):
+                cached = gen_batch_function(data_folder, image_shape, cache_dir=cache_dir, shuffle=False,
+                                            label_format=label_format)
+                uncached = gen_batch_function(data_folder, image_shape, shuffle=False, label_format=label_format)
+                cached_batches, uncached_batches = list(cached(2)), list(uncached(2))
+                assert len(cached_batches) == len(uncached_batches), 'Cached and uncached batch counts differ.'
+                for (images, labels), (expected_images, expected_labels) in zip(cached_batches, uncached_batches):
+                    assert np.array_equal(images, expected_images), 'Cached images differ from the PNG files.'
+                    assert np.array_equal(labels, expected_labels), \
+                        'Cached {} labels differ from the PNG files.'.format(label_format)
+
+        check_batches()
+        labels = np.array(preprocess_dataset(data_folder, image_shape, cache_dir).labels)
+        assert labels[0].any(), 'The synthetic ground truth has no road.'
+
+        # Replace the first ground truth image by one without road
+        gt_file = sorted(glob(os.path.join(data_folder, 'gt_image_2', '*.png')))[0]
+        Image.fromarray(np.tile(np.uint8([255, 0, 0]), frame_shape + (1,))).save(gt_file)
+        stat = os.stat(gt_file)
+        os.utime(gt_file, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+        cache = preprocess_dataset(data_folder, image_shape, cache_dir)
+        assert not cache.labels[0].any(), 'Cache not rebuilt after a ground truth image changed.'
+        assert np.array_equal(cache.labels[1:], labels[1:]), 'Unchanged labels differ after the rebuild.'
+        check_batches()
+
+        cache = preprocess_dataset(data_folder, (8, 16), cache_dir)
+        assert cache.images.shape == (5, 8, 16, 3), 'Cache not built for a new image shape.'
+        assert cache.labels.shape == (5, 8, 16), 'Wrong label shape for a new image shape.'
+        cache = preprocess_dataset(data_folder, image_shape, cache_dir)
+        assert cache.images.shape == (5,) + image_shape + (3,), 'Wrong cache after changing the image shape back.'
+    finally:
+        shutil.rmtree(work_dir)
+
+
+@test_safe
+def test_batch_augmenter(batch_augmenter, gen_batch_function, write_synthetic_kitti):
+    import shutil
+    import tempfile
+
+    rng = np.random.RandomState(0)
+    images = rng.randint(0, 256, size=(6, 16, 32, 3)).astype(np.uint8)
+    # Labels that can be recomputed from the pixels, so they must follow the image through any geometric transform
+    labels = (images[..., 0] > 127).astype(np.uint8)
+    indices = np.array([1, 3, 4])
+
+    geometric = batch_augmenter(max_scale=1.5, brightness=0., contrast=0.)
+    augmented_images, augmented_labels = geometric(images, labels, np.random.RandomState([1, 0, 0]), indices)
+    assert augmented_images.shape == (3, 16, 32, 3), 'Augmented images have the wrong shape.'
+    assert np.array_equal(augmented_labels, (augmented_images[..., 0] > 127).astype(np.uint8)), \
+        'Images and labels were transformed differently.'
+    assert not np.array_equal(augmented_images, images[indices]), 'The batch was not augmented.'
+    assert np.array_equal(images[..., 0] > 127, labels), 'The input batch was modified.'
+
+    jittered_images, jittered_labels = batch_augmenter(max_scale=1.5)(images, labels, np.random.RandomState([1, 0, 0]),
+                                                                      indices)
+    assert np.array_equal(jittered_labels, augmented_labels), 'Brightness and contrast jitter changed the labels.'
+
+    work_dir = tempfile.mkdtemp()
+    try:
+        data_folder = os.path.join(work_dir, 'training')
+        write_synthetic_kitti(data_folder, 6, (30, 60))
+
+        def epochs(seed, count=2):
+            get_batches_fn = gen_batch_function(data_folder, (16, 32), cache_dir=os.path.join(work_dir, 'cache'),
+                                                shuffle=False, augment=batch_augmenter(), seed=seed)
+            return [list(get_batches_fn(3)) for _ in range(count)]
+
+        first, second, other_seed = epochs(7), epochs(7), epochs(8, 1)
+        for epoch_batches, same_batches in zip(first, second):
+            for (images, labels), (same_images, same_labels) in zip(epoch_batches, same_batches):
+                assert np.array_equal(images, same_images) and np.array_equal(labels, same_labels), \
+                    'The same seed, epoch and batch gave different batches.'
+        assert not np.array_equal(first[0][0][0], first[1][0][0]), 'Two epochs were augmented the same way.'
+        assert not np.array_equal(first[0][0][0], other_seed[0][0][0]), 'Two seeds were augmented the same way.'
+    finally:
+        shutil.rmtree(work_dir)
+
+
+@test_safe
+def test_overlay(overlay):
+    import scipy.misc
+
+    rng = np.random.RandomState(0)
+    images = rng.randint(0, 256, size=(3, 20, 30, 3)).astype(np.uint8)
+    masks = rng.rand(3, 20, 30) > 0.5
+    # Every mask has road and background, as toimage rescales a mask with a single value
+    masks[:, 0, 0], masks[:, 0, 1] = True, False
+
+    overlays = overlay(images, masks)
+    assert overlays.shape == images.shape and overlays.dtype == np.uint8, 'Wrong overlay shape or type.'
+    for image, mask, result in zip(images, masks, overlays):
+        # The PIL path the overlays used to be made with
+        segmentation = mask.reshape(mask.shape[0], mask.shape[1], 1)
+        mask = np.dot(segmentation, np.array([[0, 255, 0, 127]]))
+        mask = scipy.misc.toimage(mask, mode='RGBA')
+        street_im = scipy.misc.toimage(image)
+        street_im.paste(mask, box=None, mask=mask)
+        assert np.array_equal(result, np.array(street_im)), 'The overlay differs from pasting the mask with PIL.'
+
+
+@test_safe
+def test_batch_prefetcher(batch_prefetcher):
+    import time
+    import threading
+    from functools import partial
+
+    def make_batches_fn(count, fail_at=None, delay=0.):
+        started = []
+
+        def task(i, batch_size):
+            started.append(i)
+            # Later batches finish first, the prefetcher must still serve them in order
+            time.sleep(delay * (count - i) / count)
+            if i == fail_at:
+                raise ValueError('Batch {} failed'.format(i))
+            return np.full(batch_size, i)
+
+        def batch_tasks(batch_size):
+            for i in range(count):
+                yield partial(task, i, batch_size)
+
+        def get_batches_fn(batch_size):
+            for load in batch_tasks(batch_size):
+                yield load()
+
+        get_batches_fn.batch_tasks = batch_tasks
+        get_batches_fn.started = started
+        return get_batches_fn
+
+    def without_tasks(get_batches_fn):
+        # A plain batch function, drained by a single background thread
+        return lambda batch_size: get_batches_fn(batch_size)
+
+    threads = threading.active_count()
+    for wrap in (lambda get_batches_fn: get_batches_fn, without_tasks):
+        prefetcher = batch_prefetcher(wrap(make_batches_fn(8, delay=0.02)), num_workers=3, prefetch=4)
+        with prefetcher:
+            batches = list(prefetcher(2))
+        assert [batch[0] for batch in batches] == list(range(8)), 'Batches out of order.'
+        assert all(len(batch) == 2 for batch in batches), 'Wrong batch size.'
+        stats = prefetcher.stats()
+        assert stats['batches'] == 8, 'Expected 8 batches in the stats, found {}.'.format(stats['batches'])
+        assert 1 <= stats['starved_batches'] <= 8 and stats['starved_time'] > 0., \
+            'Waiting for slow batches not recorded, found {}.'.format(stats)
+        prefetcher.reset_stats()
+        assert prefetcher.stats() == {'batches': 0, 'starved_batches': 0, 'starved_time': 0.}, 'Stats not reset.'
+
+        # The exception of a batch reaches the consumer after the batches before it
+        prefetcher = batch_prefetcher(wrap(make_batches_fn(8, fail_at=3)), num_workers=3, prefetch=4)
+        received = []
+        try:
+            with prefetcher:
+                for batch in prefetcher(2):
+                    received.append(batch[0])
+            assert False, 'The exception of a batch was not raised.'
+        except ValueError:
+            pass
+        assert received == [0, 1, 2], 'Expected batches 0 to 2 before the exception, found {}.'.format(received)
+
+        # A consumer raising leaves the loop early, closing the prefetcher stops the loading even though the
+        # suspended generator is still referenced, like from the frame of train_nn in the traceback
+        get_batches_fn = make_batches_fn(50, delay=0.01)
+        prefetcher = batch_prefetcher(wrap(get_batches_fn), num_workers=2, prefetch=3)
+        try:
+            with prefetcher:
+                batches = prefetcher(2)
+                for i, batch in enumerate(batches):
+                    if i == 1:
+                        raise KeyError('Training failed')
+        except KeyError:
+            pass
+        assert threading.active_count() == threads, 'Loading threads still running after close.'
+        assert len(get_batches_fn.started) <= 2 + 3 + 1, \
+            'Loaded {} batches for 2 consumed ones.'.format(len(get_batches_fn.started))
+
+
+@test_safe
+def test_metrics(confusion_matrix, road_mask, evaluate):
+    rng = np.random.RandomState(0)
+    images = rng.rand(6, 8, 10, 3)
+    predictions = images[..., 0] > 0.4
+    labels = (rng.rand(6, 8, 10) > 0.5).astype(np.uint8)
+    one_hot_labels = labels[..., np.newaxis] == np.arange(2)
+
+    truth = road_mask(labels)
+    assert truth.dtype == np.bool_ and np.array_equal(truth, labels == 1), 'Wrong road mask of class index labels.'
+    assert np.array_equal(road_mask(one_hot_labels), truth), 'Wrong road mask of one-hot labels.'
+
+    true_positives = np.sum(predictions & truth)
+    false_positives = np.sum(predictions & ~truth)
+    false_negatives = np.sum(~predictions & truth)
+    expected = {'iou': true_positives / float(true_positives + false_positives + false_negatives),
+                'precision': true_positives / float(true_positives + false_positives),
+                'recall': true_positives / float(true_positives + false_negatives),
+                'accuracy': np.mean(predictions == truth)}
+
+    def check(results, name):
+        assert sorted(results) == sorted(expected), 'Expected the metrics {}, found {}.'.format(
+            sorted(expected), sorted(results))
+        for metric, value in expected.items():
+            assert np.isclose(results[metric], value), \
+                '{}: expected {} of {}, found {}.'.format(name, metric, value, results[metric])
+
+    matrix = confusion_matrix()
+    for batch_i in range(0, len(predictions), 2):
+        matrix.update(predictions[batch_i:batch_i+2], truth[batch_i:batch_i+2])
+    check(matrix.metrics(), 'Accumulated batches')
+
+    class MaskEngine(object):
+        def predict(self, batch):
+            return None, batch[..., 0] > 0.4
+
+    for batch_labels in (labels, one_hot_labels):
+        def get_batches_fn(batch_size):
+            for batch_i in range(0, len(images), batch_size):
+                yield images[batch_i:batch_i+batch_size], batch_labels[batch_i:batch_i+batch_size]
+        check(evaluate(MaskEngine(), get_batches_fn, 4), 'evaluate')
+
+    # No road predicted or present: a perfect result rather than a division by zero
+    matrix = confusion_matrix()
+    matrix.update(np.zeros((2, 8, 10), np.bool_), np.zeros((2, 8, 10), np.bool_))
+    assert matrix.metrics() == {'iou': 1., 'precision': 1., 'recall': 1., 'accuracy': 1.}, \
+        'Wrong metrics without road, found {}.'.format(matrix.metrics())
+    matrix.update(np.zeros((1, 8, 10), np.bool_), np.ones((1, 8, 10), np.bool_))
+    results = matrix.metrics()
+    assert results['iou'] == 0. and results['recall'] == 0. and results['precision'] == 1., \
+        'Wrong metrics when no road is predicted, found {}.'.format(results)
+    assert np.isclose(results['accuracy'], 2. / 3.), 'Wrong accuracy, found {}.'.format(results['accuracy'])
+
+
+@test_safe
+def test_async_image_writer(async_image_writer):
+    import shutil
+    import tempfile
+    import threading
+    from PIL import Image
+
+    images = np.random.RandomState(0).randint(0, 256, size=(6, 8, 12, 3)).astype(np.uint8)
+    names = ['image_{}.png'.format(i) for i in range(len(images))]
+    output_dir = tempfile.mkdtemp()
+    try:
+        for output_format, compress_level in (('png', None), ('png', 1), ('png', 9), ('npy', None)):
+            run_dir = os.path.join(output_dir, '{}_{}'.format(output_format, compress_level))
+            os.makedirs(run_dir)
+            with async_image_writer(run_dir, num_workers=2, max_pending=2, output_format=output_format,
+                                    compress_level=compress_level) as writer:
+                for name, image in zip(names, images):
+                    writer.write(name, image)
+            assert writer.stats['images'] == len(images), \
+                'Expected {} images in the stats, found {}.'.format(len(images), writer.stats['images'])
+            for name, image in zip(names, images):
+                if output_format == 'npy':
+                    written = np.load(os.path.join(run_dir, os.path.splitext(name)[0] + '.npy'))
+                else:
+                    written = np.array(Image.open(os.path.join(run_dir, name)))
+                assert np.array_equal(written, image), \
+                    'Wrong {} image with compress_level {}.'.format(output_format, compress_level)
+            assert len(os.listdir(run_dir)) == len(images), 'Expected {} files, found {}.'.format(
+                len(images), os.listdir(run_dir))
+
+        # write() blocks while max_pending images are queued
+        writer = async_image_writer(output_dir, num_workers=1, max_pending=2)
+        release = threading.Event()
+        written = []
+
+        def blocked_write(name, image):
+            release.wait()
+            written.append(name)
+
+        writer._write = blocked_write
+        producer = threading.Thread(target=lambda: [writer.write(name, image) for name, image in zip(names, images)])
+        producer.start()
+        try:
+            producer.join(0.2)
+            assert producer.is_alive() and writer.count == 2, \
+                'write() did not block at max_pending images, {} were queued.'.format(writer.count)
+        finally:
+            release.set()
+            producer.join()
+        stats = writer.close()
+        assert sorted(written) == sorted(names), 'Not every queued image was written.'
+        assert stats['images'] == len(images) and stats['images_per_second'] > 0., 'Wrong stats {}.'.format(stats)
+    finally:
+        shutil.rmtree(output_dir)
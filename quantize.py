@@ -0,0 +1,204 @@
+"""
+Reduced-precision variants of an exported model and a report of their accuracy, speed and memory against the
+float32 baseline.
+
+    python quantize.py --model models/P2-frozen.pb --modes float32 float16 int8_weights int8
+"""
+import os
+import sys
+import shutil
+import time
+import argparse
+import tempfile
+from contextlib import contextmanager
+
+import numpy as np
+import tensorflow as tf
+from tensorflow.core.framework import types_pb2
+
+import helper
+from metrics import ConfusionMatrix, road_mask
+from inference import FROZEN_MODEL_PATH, OUTPUT_NAMES, batched, engine_from_graph_def, load_graph_def
+
+MODES = ['float32', 'float16', 'int8_weights', 'int8']
+_FLOAT_ATTRS = ('T', 'dtype', 'SrcT', 'DstT', 'Tparams', 'out_type')
+
+
+def to_float16(graph_def):
+    """
+    Convert every float32 weight and activation of a GraphDef to float16
+    :param graph_def: GraphDef
+    :return: New GraphDef
+    """
+    output = tf.GraphDef()
+    output.CopyFrom(graph_def)
+    for node in output.node:
+        for attr in _FLOAT_ATTRS:
+            if attr in node.attr and node.attr[attr].type == types_pb2.DT_FLOAT:
+                node.attr[attr].type = types_pb2.DT_HALF
+        if node.op == 'Const' and node.attr['value'].tensor.dtype == types_pb2.DT_FLOAT:
+            value = tf.make_ndarray(node.attr['value'].tensor).astype(np.float16)
+            node.attr['value'].tensor.CopyFrom(tf.make_tensor_proto(value, dtype=tf.float16))
+    return output
+
+
+def _transform(graph_def, transforms, input_name='image_input'):
+    from tensorflow.tools.graph_transforms import TransformGraph
+    return TransformGraph(graph_def, [input_name], OUTPUT_NAMES, transforms)
+
+
+def quantize_weights(graph_def):
+    """
+    Store the weights of a GraphDef as 8 bit, they are converted back to float32 when the graph is loaded
+    :param graph_def: GraphDef
+    :return: New GraphDef
+    """
+    return _transform(graph_def, ['quantize_weights'])
+
+
+@contextmanager
+def _capture_stderr(path):
+    """Redirect the process level stderr, where TensorFlow logs from C++, to a file"""
+    sys.stderr.flush()
+    saved = os.dup(2)
+    with open(path, 'w') as f:
+        os.dup2(f.fileno(), 2)
+    try:
+        yield
+    finally:
+        sys.stderr.flush()
+        os.dup2(saved, 2)
+        os.close(saved)
+
+
+def quantize_int8(graph_def, calibration_images, image_shape, batch_size=8):
+    """
+    Run weights and activations as 8 bit. The activation ranges are calibrated on sample images.
+    :param graph_def: GraphDef
+    :param calibration_images: uint8 array of shape (N, H, W, 3)
+    :param image_shape: Tuple - Shape of image
+    :param batch_size: Number of images per calibration step
+    :return: New GraphDef
+    """
+    quantized = _transform(graph_def, ['quantize_weights', 'quantize_nodes'])
+    logged = _transform(quantized, ['insert_logging(op=RequantizationRange, show_name=true, '
+                                    'message="__requant_min_max:")'])
+
+    log_dir = tempfile.mkdtemp()
+    try:
+        log_file = os.path.join(log_dir, 'requant_min_max.log')
+        engine = engine_from_graph_def(logged, image_shape, batch_size)
+        with _capture_stderr(log_file):
+            for batch in batched(calibration_images, batch_size):
+                engine.predict(np.array(batch))
+        engine.sess.close()
+
+        return _transform(quantized, ['freeze_requantization_ranges(min_max_log_file="{}")'.format(log_file)])
+    finally:
+        shutil.rmtree(log_dir)
+
+
+def convert(graph_def, mode, calibration_images, image_shape, batch_size=8):
+    """
+    :param graph_def: Float32 GraphDef
+    :param mode: One of MODES
+    :param calibration_images: uint8 array of shape (N, H, W, 3), only used by int8
+    :param image_shape: Tuple - Shape of image
+    :param batch_size: Number of images per calibration step
+    :return: GraphDef in the requested precision
+    """
+    if mode == 'float16':
+        return to_float16(graph_def)
+    if mode == 'int8_weights':
+        return quantize_weights(graph_def)
+    if mode == 'int8':
+        return quantize_int8(graph_def, calibration_images, image_shape, batch_size)
+    return graph_def
+
+
+def evaluate_mode(graph_def, images, labels, baseline_masks, image_shape, batch_size=8):
+    """
+    Time a model on evaluation images and compare its road masks with the ground truth and the float32 baseline
+    :return: Tuple of (results dict, road masks)
+    """
+    rss_before = helper.current_rss_mb()
+    engine = engine_from_graph_def(graph_def, image_shape, batch_size)
+    engine.predict(images[:1])
+
+    masks = []
+    start = time.time()
+    for batch_i in range(0, len(images), batch_size):
+        masks.append(engine.predict(images[batch_i:batch_i+batch_size])[1])
+    elapsed = time.time() - start
+    masks = np.concatenate(masks)
+    rss_after = helper.current_rss_mb()
+    engine.sess.close()
+
+    ground_truth = ConfusionMatrix()
+    ground_truth.update(masks, road_mask(labels))
+    results = ground_truth.metrics()
+    results['model_mb'] = graph_def.ByteSize() / 2**20
+    results['images_per_second'] = len(images) / elapsed
+    if rss_before is not None:
+        results['rss_increase_mb'] = rss_after - rss_before
+    if baseline_masks is not None:
+        baseline = ConfusionMatrix()
+        baseline.update(masks, baseline_masks)
+        results['iou_vs_float32'] = baseline.metrics()['iou']
+    return results, masks
+
+
+def compare_precisions(graph_def, data_folder, image_shape, modes=MODES, calibration_size=32, eval_size=64,
+                       batch_size=8, save_dir=None):
+    """
+    Convert a float32 model to each precision and report IoU drift, throughput and memory next to each other
+    :param graph_def: Float32 GraphDef created by "python main.py export"
+    :param data_folder: Path to the KITTI training data, the first images calibrate and the next ones evaluate
+    :param image_shape: Tuple - Shape of image
+    :param modes: Precisions to compare, float32 is always evaluated first as the baseline
+    :param calibration_size: Number of images used to calibrate the int8 activation ranges
+    :param eval_size: Number of images to evaluate on
+    :param batch_size: Number of images per sess.run
+    :param save_dir: Optional directory to write each converted model to
+    :return: Dict of results per mode
+    """
+    get_batches_fn = helper.gen_batch_function(data_folder, image_shape, shuffle=False)
+    images, labels = next(get_batches_fn(calibration_size + eval_size))
+    calibration_images = images[:calibration_size]
+    images, labels = images[calibration_size:], labels[calibration_size:]
+
+    results = {}
+    baseline_masks = None
+    for mode in ['float32'] + [mode for mode in modes if mode != 'float32']:
+        converted = convert(graph_def, mode, calibration_images, image_shape, batch_size)
+        if save_dir:
+            with open(os.path.join(save_dir, 'P2-frozen-{}.pb'.format(mode)), 'wb') as f:
+                f.write(converted.SerializeToString())
+        results[mode], masks = evaluate_mode(converted, images, labels, baseline_masks, image_shape, batch_size)
+        if baseline_masks is None:
+            baseline_masks = masks
+
+    baseline = results['float32']
+    for mode_results in results.values():
+        mode_results['speedup'] = mode_results['images_per_second'] / baseline['images_per_second']
+        mode_results['size_ratio'] = mode_results['model_mb'] / baseline['model_mb']
+    return results
+
+
+if __name__ == '__main__':
+    from benchmark import write_results
+
+    parser = argparse.ArgumentParser(description='Compare reduced-precision variants of an exported model')
+    parser.add_argument('--model', default=FROZEN_MODEL_PATH, help='Frozen float32 model')
+    parser.add_argument('--data', default='./data/data_road/training', help='KITTI road training folder')
+    parser.add_argument('--modes', nargs='+', choices=MODES, default=MODES, help='Precisions to compare')
+    parser.add_argument('--calibration', type=int, default=32, help='Number of calibration images')
+    parser.add_argument('--eval', type=int, default=64, help='Number of evaluation images')
+    parser.add_argument('--batch-size', type=int, default=8, help='Images per inference step')
+    parser.add_argument('--save-dir', help='Write each converted model to this directory')
+    parser.add_argument('--output', help='Write the JSON results to this file')
+    args = parser.parse_args()
+
+    results = compare_precisions(load_graph_def(args.model), args.data, (160, 576), args.modes, args.calibration,
+                                 args.eval, args.batch_size, args.save_dir)
+    write_results('precision', results, args.output)
@@ -0,0 +1,256 @@
+"""
+HTTP server for road segmentation. The model is loaded once into a warm session and concurrent requests are
+collected into micro-batches, so the network runs on several images per sess.run while no request waits longer
+than the batching deadline.
+
+    python serve.py --model models/P2-frozen.pb --port 8000
+    curl --data-binary @image.png 'http://localhost:8000/segment?format=rle'
+    curl http://localhost:8000/stats
+
+POST /segment takes a PNG or JPEG image of any size and returns its road mask at the same size, either as a
+grayscale PNG (format=png, the default) or as JSON with the shape and run lengths of the mask (format=rle, see
+mask_io.rle_encode). GET /stats returns the queue depth, the batch size histogram and the p50/p99 latency.
+"""
+import io
+import json
+import time
+import queue
+import argparse
+import threading
+from collections import Counter, deque
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import urlparse, parse_qs
+
+import numpy as np
+import scipy.misc
+from PIL import Image
+
+import mask_io
+from inference import FROZEN_MODEL_PATH, load_frozen_model
+
+OUTPUT_FORMATS = ('png', 'rle')
+
+
+def resize_nearest(mask, shape):
+    """
+    :param mask: Array of shape (H, W)
+    :param shape: Tuple - Shape to resize to
+    :return: Array of shape shape, sampled from mask with nearest neighbour interpolation
+    """
+    if mask.shape[:2] == tuple(shape):
+        return mask
+    rows = np.arange(shape[0]) * mask.shape[0] // shape[0]
+    cols = np.arange(shape[1]) * mask.shape[1] // shape[1]
+    return mask[rows[:, np.newaxis], cols]
+
+
+class DynamicBatcher(object):
+    """
+    Collect images submitted from any thread into batches for one InferenceEngine. A batch is run as soon as it
+    is full or max_latency seconds after its first image arrived, whichever comes first.
+    """
+    def __init__(self, engine, max_batch_size=None, max_latency=0.01, history=1000):
+        """
+        :param engine: InferenceEngine, only used from the batching thread
+        :param max_batch_size: Maximum number of images per batch, engine.batch_size by default
+        :param max_latency: Seconds a request may wait for other requests to join its batch
+        :param history: Number of most recent requests the latency percentiles are computed over
+        """
+        self.engine = engine
+        self.max_batch_size = max_batch_size or engine.batch_size
+        self.max_latency = max_latency
+        self.requests = queue.Queue()
+        self.batch_sizes = Counter()
+        self.latencies = deque(maxlen=history)
+        self.count = 0
+        self.lock = threading.Lock()
+        self._stop = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def submit(self, image):
+        """
+        :param image: RGB uint8 array of shape (H, W, 3) of any size, it is resized to engine.image_shape
+        :return: Future of the bool road mask of shape (H, W)
+        """
+        future = Future()
+        if self._stop.is_set():
+            future.set_exception(RuntimeError('The batcher is closed'))
+        else:
+            self.requests.put((time.time(), image, future))
+        return future
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                batch = [self.requests.get(timeout=0.1)]
+            except queue.Empty:
+                continue
+            deadline = batch[0][0] + self.max_latency
+            while len(batch) < self.max_batch_size:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self.requests.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            self._process(batch)
+
+    def _process(self, batch):
+        try:
+            images = np.array([scipy.misc.imresize(image, self.engine.image_shape) for _, image, _ in batch])
+            _, masks = self.engine.predict(images)
+        except Exception as e:
+            for _, _, future in batch:
+                future.set_exception(e)
+            return
+
+        for (_, image, future), mask in zip(batch, masks):
+            future.set_result(resize_nearest(mask, image.shape[:2]))
+
+        done = time.time()
+        with self.lock:
+            self.batch_sizes[len(batch)] += 1
+            self.latencies.extend(done - submitted for submitted, _, _ in batch)
+            self.count += len(batch)
+
+    def stats(self):
+        """
+        :return: Dict with the queue depth, the number of requests, the batch size histogram and the p50/p99
+                 latency in ms from submitting an image to its mask being ready
+        """
+        with self.lock:
+            latencies = np.array(self.latencies) * 1000.
+            stats = {'queue_depth': self.requests.qsize(),
+                     'requests': self.count,
+                     'batches': sum(self.batch_sizes.values()),
+                     'batch_size_histogram': {str(size): count for size, count in sorted(self.batch_sizes.items())}}
+        stats['latency_p50_ms'] = float(np.percentile(latencies, 50)) if len(latencies) else None
+        stats['latency_p99_ms'] = float(np.percentile(latencies, 99)) if len(latencies) else None
+        return stats
+
+    def close(self):
+        """Stop the batching thread, requests still waiting fail"""
+        self._stop.set()
+        self.thread.join()
+        while True:
+            try:
+                _, _, future = self.requests.get_nowait()
+            except queue.Empty:
+                break
+            future.set_exception(RuntimeError('The batcher is closed'))
+
+
+class SegmentationHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        path = urlparse(self.path).path
+        if path == '/stats':
+            self._send(json.dumps(self.server.batcher.stats()).encode(), 'application/json')
+        elif path == '/health':
+            self._send(b'ok', 'text/plain')
+        else:
+            self.send_error(404)
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        if url.path != '/segment':
+            self.send_error(404)
+            return
+        output_format = parse_qs(url.query).get('format', ['png'])[0]
+        if output_format not in OUTPUT_FORMATS:
+            self.send_error(400, 'Unknown format {}, expected one of {}'.format(output_format, OUTPUT_FORMATS))
+            return
+
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        try:
+            image = np.array(Image.open(io.BytesIO(body)).convert('RGB'))
+        except (OSError, ValueError):
+            self.send_error(400, 'The request body is not an image')
+            return
+
+        try:
+            mask = self.server.batcher.submit(image).result(timeout=self.server.request_timeout)
+        except Exception as e:
+            self.send_error(503, str(e))
+            return
+
+        if output_format == 'png':
+            self._send(mask_io.png_encode(mask), 'image/png')
+        else:
+            self._send(json.dumps({'shape': list(mask.shape),
+                                   'counts': mask_io.rle_encode(mask).tolist()}).encode(), 'application/json')
+
+    def _send(self, body, content_type):
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        if not self.server.quiet:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+
+class SegmentationServer(ThreadingMixIn, HTTPServer):
+    """HTTP server handling every request in its own thread, the requests meet in the DynamicBatcher"""
+    daemon_threads = True
+
+    def __init__(self, batcher, host='127.0.0.1', port=0, request_timeout=30., quiet=False):
+        """
+        :param batcher: DynamicBatcher, closed together with the server
+        :param host: Address to listen on
+        :param port: Port to listen on, 0 picks a free port
+        :param request_timeout: Seconds to wait for a mask before answering 503
+        :param quiet: Do not log every request
+        """
+        HTTPServer.__init__(self, (host, port), SegmentationHandler)
+        self.batcher = batcher
+        self.request_timeout = request_timeout
+        self.quiet = quiet
+        self.thread = None
+
+    @property
+    def url(self):
+        return 'http://{}:{}'.format(*self.server_address[:2])
+
+    def start(self):
+        """Serve from a background thread"""
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def close(self):
+        if self.thread is not None:
+            self.shutdown()
+            self.thread.join()
+        self.server_close()
+        self.batcher.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve road segmentation over HTTP')
+    parser.add_argument('--model', default=FROZEN_MODEL_PATH, help='Frozen model')
+    parser.add_argument('--host', default='127.0.0.1', help='Address to listen on')
+    parser.add_argument('--port', type=int, default=8000, help='Port to listen on')
+    parser.add_argument('--batch-size', type=int, default=8, help='Maximum images per inference step')
+    parser.add_argument('--max-latency-ms', type=float, default=10., help='Maximum time a request waits for a batch')
+    args = parser.parse_args()
+
+    engine = load_frozen_model(args.model, (160, 576), batch_size=args.batch_size)
+    batcher = DynamicBatcher(engine, max_latency=args.max_latency_ms / 1000.)
+    with SegmentationServer(batcher, args.host, args.port) as server:
+        print('Serving on %s' % server.url)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
@@ -0,0 +1,262 @@
+import os.path
+import time
+import queue
+import argparse
+import threading
+from glob import glob
+
+import numpy as np
+import scipy.misc
+import tensorflow as tf
+
+from inference import InferenceEngine, overlay
+
+IMAGE_EXTENSIONS = ('*.png', '*.jpg', '*.jpeg')
+
+
+def video_frames(path):
+    """
+    Read frames from a video file or from a directory containing an image sequence
+    :param path: Path to a video file or to a directory of images, the images are read in sorted order
+    :return: Generator of RGB uint8 frames
+    """
+    if os.path.isdir(path):
+        frame_files = sorted(f for extension in IMAGE_EXTENSIONS for f in glob(os.path.join(path, extension)))
+        for frame_file in frame_files:
+            yield scipy.misc.imread(frame_file, mode='RGB')
+        return
+
+    # OpenCV is only needed to decode video files
+    import cv2
+    capture = cv2.VideoCapture(path)
+    try:
+        while True:
+            success, frame = capture.read()
+            if not success:
+                break
+            yield cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+    finally:
+        capture.release()
+
+
+def synthetic_frames(count, frame_shape=(375, 1242), seed=0):
+    """
+    Generate random frames, for tests and benchmarks without a video
+    :param count: Number of frames
+    :param frame_shape: Tuple - Shape of a frame
+    :param seed: Random seed
+    :return: Generator of RGB uint8 frames
+    """
+    rng = np.random.RandomState(seed)
+    for _ in range(count):
+        yield rng.randint(0, 256, size=(frame_shape[0], frame_shape[1], 3), dtype=np.uint8)
+
+
+class ImageSequenceSink(object):
+    """Write frames as numbered PNG files"""
+    def __init__(self, output_dir):
+        os.makedirs(output_dir, exist_ok=True)
+        self.output_dir = output_dir
+        self.count = 0
+
+    def __call__(self, frame):
+        scipy.misc.imsave(os.path.join(self.output_dir, 'frame_%06d.png' % self.count), frame)
+        self.count += 1
+
+    def close(self):
+        pass
+
+
+class VideoSink(object):
+    """Write frames to a video file"""
+    def __init__(self, path, fps=10.):
+        self.path = path
+        self.fps = fps
+        self.writer = None
+
+    def __call__(self, frame):
+        import cv2
+        if self.writer is None:
+            self.writer = cv2.VideoWriter(self.path, cv2.VideoWriter_fourcc(*'mp4v'), self.fps,
+                                          (frame.shape[1], frame.shape[0]))
+        self.writer.write(cv2.cvtColor(frame, cv2.COLOR_RGB2BGR))
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.release()
+
+
+class _Stage(object):
+    """Accumulate the time spent in one stage of the pipeline"""
+    def __init__(self):
+        self.seconds = 0.
+        self.frames = 0
+
+    def add(self, seconds, frames=1):
+        self.seconds += seconds
+        self.frames += frames
+
+    def latency_ms(self):
+        return 1000. * self.seconds / max(self.frames, 1)
+
+
+_END = object()
+
+
+def segment_stream(engine, frames, sink, queue_size=16):
+    """
+    Segment a stream of frames. Decoding, inference and encoding run in separate threads connected by bounded
+    queues so they overlap, frames are micro-batched for inference and written to the sink in order.
+    :param engine: InferenceEngine, frames are grouped into batches of at most engine.batch_size
+    :param frames: Iterable of RGB uint8 frames of any size, they are resized to engine.image_shape
+    :param sink: Callable that is given every overlay frame in order
+    :param queue_size: Maximum number of frames waiting between two stages
+    :return: Dict with the number of frames, the sustained FPS and the mean per-frame latency of every stage in ms
+    """
+    decoded = queue.Queue(maxsize=queue_size)
+    segmented = queue.Queue(maxsize=queue_size)
+    stop = threading.Event()
+    stages = {'decode': _Stage(), 'inference': _Stage(), 'encode': _Stage()}
+    errors = []
+
+    def put(target, item):
+        while not stop.is_set():
+            try:
+                target.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def decode():
+        try:
+            frame_iter = iter(frames)
+            while not stop.is_set():
+                start = time.time()
+                frame = next(frame_iter, _END)
+                if frame is _END:
+                    break
+                frame = scipy.misc.imresize(frame, engine.image_shape)
+                stages['decode'].add(time.time() - start)
+                if not put(decoded, frame):
+                    return
+        except Exception as e:
+            errors.append(e)
+        put(decoded, _END)
+
+    def get(source):
+        while not stop.is_set():
+            try:
+                return source.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        return _END
+
+    def encode():
+        try:
+            while True:
+                frame = segmented.get()
+                if frame is _END:
+                    return
+                start = time.time()
+                sink(frame)
+                stages['encode'].add(time.time() - start)
+        except Exception as e:
+            errors.append(e)
+            stop.set()
+
+    threads = [threading.Thread(target=decode, daemon=True), threading.Thread(target=encode, daemon=True)]
+    for thread in threads:
+        thread.start()
+
+    start_time = time.time()
+    count = 0
+    try:
+        finished = False
+        while not finished and not stop.is_set():
+            # Block for the first frame, then take whatever else is ready up to the batch size
+            batch = [get(decoded)]
+            while len(batch) < engine.batch_size:
+                try:
+                    batch.append(decoded.get_nowait())
+                except queue.Empty:
+                    break
+            if batch[-1] is _END:
+                finished = True
+                batch.pop()
+            if not batch:
+                break
+
+            start = time.time()
+            images = np.array(batch)
+            _, masks = engine.predict(images)
+            overlays = overlay(images, masks)
+            stages['inference'].add(time.time() - start, len(batch))
+
+            for frame in overlays:
+                if not put(segmented, frame):
+                    break
+            count += len(batch)
+    finally:
+        put(segmented, _END)
+        threads[1].join()
+        stop.set()
+        threads[0].join()
+
+    if errors:
+        raise errors[0]
+
+    elapsed = time.time() - start_time
+    stats = {'frames': count, 'seconds': elapsed, 'fps': count / max(elapsed, 1e-9)}
+    for name, stage in stages.items():
+        stats[name + '_latency_ms'] = stage.latency_ms()
+    return stats
+
+
+def segment_video(input_path, output_path, epoch, image_shape=(160, 576), batch_size=4, fps=10.):
+    """
+    Restore a trained model and segment a video file or an image sequence directory
+    :param input_path: Video file or directory of frames
+    :param output_path: Video file, or a directory to write numbered PNG frames to
+    :param epoch: Epoch of the checkpoint to restore
+    :param image_shape: Tuple - Shape the frames are resized to
+    :param batch_size: Number of frames per sess.run
+    :param fps: Frame rate of the output video
+    :return: Stats from segment_stream
+    """
+    import main
+
+    with tf.Session() as sess:
+        input_image, keep_prob, vgg_layer3_out, vgg_layer4_out, vgg_layer7_out = main.load_vgg(
+            sess, os.path.join(main.DATA_PATH, 'vgg'))
+        last_layer = main.layers(vgg_layer3_out, vgg_layer4_out, vgg_layer7_out, main.NUM_CLASSES)
+        main.load_model(sess, epoch)
+
+        engine = InferenceEngine(sess, input_image, image_shape, logits=last_layer, keep_prob=keep_prob,
+                                 batch_size=batch_size)
+        if os.path.splitext(output_path)[1]:
+            sink = VideoSink(output_path, fps)
+        else:
+            sink = ImageSequenceSink(output_path)
+        try:
+            return segment_stream(engine, video_frames(input_path), sink)
+        finally:
+            sink.close()
+
+
+if __name__ == '__main__':
+    import main
+
+    parser = argparse.ArgumentParser(description='Segment the road in a video with a trained FCN')
+    parser.add_argument('input', help='Video file or directory of frames')
+    parser.add_argument('output', help='Output video file, or a directory for PNG frames')
+    parser.add_argument('--epoch', type=int, default=main.EPOCHS - 1,
+                        help='Epoch of the checkpoint to restore, the last one of a training run by default')
+    parser.add_argument('--batch-size', type=int, default=4, help='Frames per inference step')
+    parser.add_argument('--fps', type=float, default=10., help='Frame rate of the output video')
+    args = parser.parse_args()
+
+    stats = segment_video(args.input, args.output, args.epoch, batch_size=args.batch_size, fps=args.fps)
+    print('{frames} frames in {seconds:.1f}s, {fps:.1f} FPS'.format(**stats))
+    print('Per frame latency: decode {decode_latency_ms:.1f} ms, inference {inference_latency_ms:.1f} ms, '
+          'encode {encode_latency_ms:.1f} ms'.format(**stats))